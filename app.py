@@ -1,8 +1,12 @@
-from chat import torchBot
+from chat import cache_stats, torchBot
+import atexit
 import datetime
+from functools import partial, wraps
+import hmac
 import os
 import json
-from flask import Flask, request, abort
+import uuid
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
 from flask.logging import create_logger
 
 from linebot import (
@@ -13,25 +17,108 @@ from linebot.exceptions import (
 )
 from linebot.models import (
     MessageEvent, TextMessage, StickerMessage, TextSendMessage, PostbackEvent,
-    QuickReply, PostbackAction, ConfirmTemplate, TemplateSendMessage, StickerSendMessage
+    QuickReply, PostbackAction, ConfirmTemplate, TemplateSendMessage
 )
 from google.cloud import datastore
 import config
 
-from send_email import send_notice
-from quick_buttons import number_buttons, menu_buttons, action_irregular_buttons, action_others_buttons, teacher_buttons
+from send_email import deliver
+from outbox import Outbox
+from datastore_session import EventSession, InstrumentedClient
+from entity_cache import EntityCache
+from digest import DigestQueue
+from line_http import PooledHttpClient
+from broadcast import Broadcaster, recipients
+from replies import Replies, STICKER_REPLY, text
+from webhook_executor import KeyedExecutor, QueuedWebhookHandler
+from router import Router, PostbackRouter
+from conversation import message_state
+from metrics import REGISTRY
+from quick_buttons import teacher_buttons, next_page_button
+from daily_counts import daily_counts, increment, local_date, summary_text
+from data_export import ARCHIVE_COLUMNS, KINDS, build_query, iter_entities, stream_csv, stream_jsonl
+from cascade_delete import CascadeDeleter, user_keys
+from roster import claim, find_claimable, import_roster, parse_roster, roster_key
+from archive import archived_months, iter_archived, store_from_config
+from teacher_notices import PAGE_KIND, PAGE_PREFIX, day_range, fetch_page, notice_texts, page_data
 
 app = Flask(__name__)
 log = create_logger(app)
-client = datastore.Client()
-line_bot_api = LineBotApi(config._LINE_TOKEN)
-handler = WebhookHandler(config._LINE_SECRET)
+
+WEBHOOK_SECONDS = REGISTRY.histogram(
+    "webhook_request_seconds", "Time to answer POST /callback").labels()
+WEBHOOK_ERRORS = REGISTRY.counter(
+    "webhook_request_errors_total", "POST /callback requests that raised or were rejected").labels()
+WEBHOOK_IN_FLIGHT = REGISTRY.gauge(
+    "webhook_requests_in_flight", "POST /callback requests being answered").labels()
+EVENTS = REGISTRY.counter("webhook_events_total", "LINE events handled, by type", ["type"])
+EVENT_SECONDS = REGISTRY.histogram(
+    "webhook_event_seconds", "Time to handle one LINE event", ["type"])
+EVENT_ERRORS = REGISTRY.counter(
+    "webhook_event_errors_total", "LINE events whose handler raised", ["type"])
+EVENTS_IN_FLIGHT = REGISTRY.gauge("webhook_events_in_flight", "LINE events being handled")
+QUANTILES = REGISTRY.gauge(
+    "webhook_latency_quantile_seconds",
+    "p50 and p99 estimated from the webhook_request_seconds and webhook_event_seconds buckets",
+    ["histogram", "type", "quantile"])
+for quantile in (0.5, 0.99):
+    QUANTILES.labels("webhook_request_seconds", "", str(quantile)).function = partial(
+        WEBHOOK_SECONDS.quantile, quantile)
+client = InstrumentedClient()
+entity_cache = EntityCache(
+    ("UserKind", "ActionKind", "ConfigKind"), config.ENTITY_CACHE_SIZE,
+    config.ENTITY_CACHE_TTL, config.ENTITY_CACHE_VERIFY_AFTER)
+line_bot_api = LineBotApi(
+    config._LINE_TOKEN,
+    timeout=(config.LINE_CONNECT_TIMEOUT, config.LINE_READ_TIMEOUT),
+    http_client=partial(PooledHttpClient, pool_size=config.LINE_POOL_SIZE,
+                        retries=config.LINE_RETRIES))
+# replies and pushes go out through line_sender, see use_line_sender
+line_sender = line_bot_api
+if config.WEBHOOK_WORKERS > 0:
+    executor = KeyedExecutor(config.WEBHOOK_WORKERS, config.WEBHOOK_MAX_PENDING)
+    handler = QueuedWebhookHandler(config._LINE_SECRET, executor)
+    atexit.register(executor.shutdown, config.WEBHOOK_DRAIN_SECONDS)
+else:
+    executor = None
+    handler = WebhookHandler(config._LINE_SECRET)
+for setting in ("OUTBOX_PATH", "DIGEST_PATH"):
+    if getattr(config, setting) is None:
+        raise RuntimeError(
+            f"{setting} is required on Cloud Run: queued notices in the in-memory "
+            "filesystem are lost when the instance is recycled. Point it at a "
+            "persistent volume mount (see README).")
+outbox = Outbox(config.OUTBOX_PATH, deliver,
+                max_attempts=config.OUTBOX_MAX_ATTEMPTS,
+                backoff=config.OUTBOX_BACKOFF_SECONDS,
+                retention=config.OUTBOX_RETENTION_DAYS * 86400)
+outbox.start(config.OUTBOX_WORKERS)
+digest = DigestQueue(config.DIGEST_PATH, outbox)
+digest.start()
+archive_store = store_from_config(client)
+broadcaster = Broadcaster(line_bot_api, config.BROADCAST_WORKERS, config.BROADCAST_RATE)
+deleter = CascadeDeleter(client, entity_cache)
+deleter.resume()
+
+
+def use_line_sender(sender):
+    """
+    Sends replies, pushes and broadcast reports through `sender` instead of
+    line_bot_api; asgi.py passes one that schedules them on its event loop.
+    Broadcast multicasts stay on line_bot_api, they block on the
+    broadcaster's own threads under either entry point.
+    """
+
+    global line_sender
+    line_sender = sender
 
 
 with open('language/japanese.json') as japanese:
     japanese_words = json.load(japanese)
 with open('language/english.json') as english:
     english_words = json.load(english)
+japanese_replies = Replies(japanese_words)
+english_replies = Replies(english_words)
 
 
 @ app.route("/callback", methods=['POST'])
@@ -44,359 +131,639 @@ def callback():
     log.info("Request body: " + body)
 
     # handle webhook body
+    WEBHOOK_IN_FLIGHT.inc()
     try:
-        handler.handle(body, signature)
+        with WEBHOOK_SECONDS.time(WEBHOOK_ERRORS):
+            handler.handle(body, signature)
     except InvalidSignatureError:
         print("Invalid signature. Please check your channel access token/channel secret.")
         abort(400)
+    finally:
+        WEBHOOK_IN_FLIGHT.dec()
 
     return 'OK'
 
 
+@ app.route("/metrics", methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+@ app.route("/stats", methods=['GET'])
+def stats():
+    # delete jobs are keyed by LINE user ID
+    check_export_token()
+    return jsonify(webhook=executor.stats() if executor else None,
+                   entity_cache=entity_cache.stats(),
+                   chat_cache=cache_stats(),
+                   delete_jobs=deleter.progress(),
+                   broadcasts=broadcaster.progress(),
+                   routes=dict(message=message_routes.stats(),
+                               registration=registration_routes.stats(),
+                               postback=postback_routes.stats()),
+                   line_latency=line_bot_api.http_client.stats())
+
+
+def check_export_token():
+    # exports and /stats are authenticated with "Authorization: Bearer <EXPORT_TOKEN>"
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    # compared as bytes, compare_digest only takes ASCII str
+    if (not config.EXPORT_TOKEN or scheme != 'Bearer'
+            or not hmac.compare_digest(token.encode(), config.EXPORT_TOKEN.encode())):
+        abort(401)
+
+
+def date_arg(name, end=False):
+    """
+    createdAt bound from a "YYYY-MM-DD" query argument, 400 if malformed.
+    """
+
+    if name not in request.args:
+        return None
+    try:
+        return day_range(request.args[name])[1 if end else 0]
+    except ValueError:
+        abort(400)
+
+
+def int_arg(name):
+    """
+    Integer query argument, 400 if malformed.
+    """
+
+    if name not in request.args:
+        return None
+    try:
+        return int(request.args[name])
+    except ValueError:
+        abort(400)
+
+
+def export_response(chunks, columns, name):
+    if request.args.get('format') == 'jsonl':
+        body, mimetype, extension = stream_jsonl(chunks, columns), 'application/x-ndjson', 'jsonl'
+    else:
+        body, mimetype, extension = stream_csv(chunks, columns), 'text/csv', 'csv'
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={name}.{extension}'})
+
+
+@ app.route("/export/<name>", methods=['GET'])
+def export_rows(name):
+    check_export_token()
+    if name not in KINDS:
+        abort(404)
+    kind, columns = KINDS[name]
+    start = date_arg('from')
+    end = date_arg('to', end=True)
+    query = build_query(client, kind, start, end,
+                        int_arg('grade'), int_arg('classroom'))
+    return export_response(iter_entities(query), columns, name)
+
+
+@ app.route("/export/archive", methods=['GET'])
+def export_archive_months():
+    check_export_token()
+    return jsonify(months=archived_months(client))
+
+
+@ app.route("/export/archive/<month>", methods=['GET'])
+def export_archive(month):
+    check_export_token()
+    return export_response(iter_archived(client, archive_store, month),
+                           ARCHIVE_COLUMNS, f"notices-{month}")
+
+
+@ app.route("/import/roster", methods=['POST'])
+def import_roster_csv():
+    # CSV body with child_name,grade,classroom,language columns
+    check_export_token()
+    timestamp = int(datetime.datetime.now().timestamp() * 1e3)
+    try:
+        entities = parse_roster(client, request.get_data(as_text=True), timestamp)
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    return jsonify(imported=import_roster(client, entities, config.ROSTER_IMPORT_WORKERS))
+
+
+def reply(session, reply_token, messages):
+    # write the event's changes before answering, so the next tap sees them
+    session.commit()
+    line_sender.reply_message(reply_token, messages)
+
+
+class Turn:
+    """
+    One webhook event with the entities its handler works on, read with a
+    single get_multi and written back by reply().
+    """
+
+    def __init__(self, event):
+        self.event = event
+        self.user_id = event.source.user_id
+        self.session = EventSession(client, entity_cache)
+        self.user_key = client.key("UserKind", self.user_id)
+        self.action_key = client.key("ActionKind", self.user_id, parent=self.user_key)
+        self.config_key = client.key("ConfigKind", "email")
+        self.user, self.action, self.configuration = self.session.get_multi(
+            [self.user_key, self.action_key, self.config_key])
+        self.set_language(self.user and self.user["isEnglish"] is True)
+
+    def set_language(self, english):
+        if english:
+            self.words, self.replies = english_words, english_replies
+        else:
+            self.words, self.replies = japanese_words, japanese_replies
+
+    def reply(self, messages):
+        reply(self.session, self.event.reply_token, messages)
+
+
+message_routes = Router("message")
+registration_routes = PostbackRouter("registration")
+postback_routes = PostbackRouter("postback")
+
+
+def timed_event(event_type):
+    """
+    Counts and times a LINE event handler, with its metrics children looked
+    up once here rather than per event.
+    """
+
+    events = EVENTS.labels(event_type)
+    seconds = EVENT_SECONDS.labels(event_type)
+    errors = EVENT_ERRORS.labels(event_type)
+    in_flight = EVENTS_IN_FLIGHT.labels()
+    for quantile in (0.5, 0.99):
+        QUANTILES.labels("webhook_event_seconds", event_type, str(quantile)).function = partial(
+            seconds.quantile, quantile)
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(event):
+            events.inc()
+            in_flight.inc()
+            try:
+                with seconds.time(errors):
+                    return function(event)
+            finally:
+                in_flight.dec()
+        return wrapper
+    return decorator
+
+
 @ handler.add(MessageEvent, message=TextMessage)
+@ timed_event("message")
 def handle_message(event):
     print("message event", event)
-    user_id = event.source.user_id
-    user_key = client.key("UserKind", user_id)
-    user = client.get(user_key)
-    action_key = client.key("ActionKind", user_id, parent=user_key)
-    action = client.get(action_key)
-    if user and (user["isEnglish"] is True):
-        words = english_words
-    else:
-        words = japanese_words
-    if user is None:
-        user = datastore.Entity(key=user_key)
-        user.update({
-            "child_name": "",
-            "grade": -1,
-            "classroom": -1,
-            "isEnglish": False,
-            "isTeacher": False,
-            "createdAt": event.timestamp,
-        })
-        client.put(user)
-        confirm_template = ConfirmTemplate(text="子どもの登録がまだっぽいので、まずは言語を選んでください。Seems like you haven't registered your child yet. Firstly select your language please.", actions=[
-            PostbackAction(label='日本語', data="language_japanese",
-                           display_text='日本語'),
-            PostbackAction(label='English',
-                           data="language_english", display_text='English'),
-        ])
-        template_message = TemplateSendMessage(
-            alt_text='Confirm language', template=confirm_template)
-        line_bot_api.reply_message(event.reply_token, template_message)
-    elif user["child_name"] == "":
-        if user["classroom"] == -1:
-            client.delete(user_key)
-            messages = [TextSendMessage(text=words["bug"]), StickerSendMessage(
-                package_id="11538",
-                sticker_id="51626499")]
-            line_bot_api.reply_message(event.reply_token, messages)
-        else:
-            with client.transaction():
-                user["child_name"] = event.message.text
-                client.put(user)
-            messages = [StickerSendMessage(package_id="11537", sticker_id="52002745"),
-                        TextSendMessage(text=words["registerCompleted"],
-                                        quick_reply=QuickReply(items=menu_buttons(words)))]
-            line_bot_api.reply_message(event.reply_token, messages)
-    elif action:
-        if action["when"] == "":
-            client.delete(action_key)
-            messages = [StickerSendMessage(
-                package_id="11538", sticker_id="51626499"),
-                TextSendMessage(text=words["bug"],
-                                quick_reply=QuickReply(items=menu_buttons(words)))]
-            line_bot_api.reply_message(event.reply_token, messages)
-        elif action["description"] == "":
-            with client.transaction():
-                action["description"] = event.message.text
-                client.put(action)
-            confirm_submit = words["confirmSubmit"]
-            submit_type = words[action["category"]]
-            date_time = words["dateTime"]
-            when = action["when"]
-            description_key = words["description"]
-            description_value = action["description"]
-            if when == "NA":
-                message = f"{confirm_submit} {submit_type} {description_key}: {description_value}"
-            else:
-                message = f"{confirm_submit} {submit_type} {date_time}: {when}, {description_key}: {description_value}"
-            confirm_template = ConfirmTemplate(text=message, actions=[
-                PostbackAction(label=words["yes"], data="action_submit_yes",
-                               display_text=words["yes"]),
-                PostbackAction(label=words["cancel"], data="action_cancel",
-                               display_text=words["cancel"]),
-            ])
-            template_message = TemplateSendMessage(
-                alt_text='Confirm submit', template=confirm_template)
-            line_bot_api.reply_message(event.reply_token, template_message)
-    elif event.message.text == "Teacher on":
-        with client.transaction():
-            user["isTeacher"] = True
-            client.put(user)
-        messages = [StickerSendMessage(
-            package_id="11538", sticker_id="51626514"),
-            TextSendMessage(text=words["teacherMode"] + ": ON",
-                            quick_reply=QuickReply(items=teacher_buttons(words)))]
-        line_bot_api.reply_message(event.reply_token, messages)
-    elif user["isTeacher"] is True:
-        config_key = client.key("ConfigKind", "email")
-        configuration = client.get(config_key)
-        if configuration["email"] == "":
-            with client.transaction():
-                configuration["email"] = event.message.text
-                client.put(configuration)
-            messages = [StickerSendMessage(
-                package_id="11537", sticker_id="52002768"),
-                TextSendMessage(text=words["setEmailDone"],
-                                quick_reply=QuickReply(items=teacher_buttons(words)))]
-            line_bot_api.reply_message(event.reply_token, messages)
-        else:
-            with client.transaction():
-                user["isTeacher"] = False
-                client.put(user)
-            messages = [StickerSendMessage(package_id="11538",
-                                           sticker_id="51626494"),
-                        TextSendMessage(text=words["teacherMode"] + ": OFF",
-                                        quick_reply=QuickReply(items=menu_buttons(words)))]
-            line_bot_api.reply_message(event.reply_token, messages)
-    else:
-        messages = []
-        torch_message = torchBot(event.message.text)
-        messages.append(TextSendMessage(text=torch_message,
-                                        quick_reply=QuickReply(items=menu_buttons(words))))
-        if "I don't know" in torch_message:
-            messages.insert(0, StickerSendMessage(
-                package_id="11537",
-                sticker_id="52002744"))
-        line_bot_api.reply_message(event.reply_token, messages)
+    turn = Turn(event)
+    message_routes.dispatch(message_state(turn), turn)
 
 
 @ handler.add(PostbackEvent)
+@ timed_event("postback")
 def handle_postback(event):
     print("postback event", event)
-    user_id = event.source.user_id
-    user_key = client.key("UserKind", user_id)
-    user = client.get(user_key)
-    if user["isEnglish"] is True:
-        words = english_words
+    turn = Turn(event)
+    if turn.user["child_name"] == "":
+        registration_routes.dispatch(event.postback.data, turn)
     else:
-        words = japanese_words
-    if user["child_name"] == "":
-        if "language_" in event.postback.data:
-            if event.postback.data == "language_english":
-                with client.transaction():
-                    user["isEnglish"] = True
-                    client.put(user)
-                words = english_words
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(
-                    text=words["grade"],
-                    quick_reply=QuickReply(
-                        items=number_buttons(6, "grade"))))
-        elif "grade_" in event.postback.data:
-            with client.transaction():
-                user["grade"] = int(event.postback.data[6:7])
-                client.put(user)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(
-                    text=words["classroom"],
-                    quick_reply=QuickReply(
-                        items=number_buttons(5, "classroom"))))
-        elif "classroom_" in event.postback.data:
-            with client.transaction():
-                user["classroom"] = int(event.postback.data[10:11])
-                client.put(user)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=words["childName"]))
-    elif "menu_" in event.postback.data:
-        category = event.postback.data[5:]
-        if category == "answerSubmit":
-            messages = [StickerSendMessage(
-                package_id="11538",
-                sticker_id="51626508"),
-                TextSendMessage(text=words["underConstruction"],
-                                quick_reply=QuickReply(items=menu_buttons(words)))]
-            line_bot_api.reply_message(event.reply_token, messages)
-        else:
-            if category == "absence":
-                quick_buttons = action_irregular_buttons(
-                    words, ["chooseDate",
-                            "absence", "date"])
-            elif category == "tardiness":
-                quick_buttons = action_irregular_buttons(
-                    words, ["chooseDateTime",
-                            "tardiness", "datetime"])
-            elif category == "leave_early":
-                quick_buttons = action_irregular_buttons(
-                    words, ["chooseDateTime",
-                            "leave_early", "datetime"])
-            elif category == "contactQuestion":
-                quick_buttons = action_others_buttons(
-                    words, ["contact", "question", "consult"])
-            # elif category == "answerSubmit":
-            #     quick_buttons = action_others_buttons(
-            #         words, ["answer", "fileSubmit"])
-            elif category == "others":
-                quick_buttons = action_others_buttons(
-                    words, ["technical", "others"])
-            action_key = client.key("ActionKind", user_id, parent=user_key)
-            action = datastore.Entity(key=action_key)
-            action.update(
-                {
-                    "category": category,
-                    "when": "",
-                    "description": "",
-                }
-            )
-            client.put(action)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(
-                    text=words[f"proceed_{category}"],
-                    quick_reply=QuickReply(
-                        items=quick_buttons)))
-    elif "action_" in event.postback.data:
-        action_key = client.key("ActionKind", user_id, parent=user_key)
-        action = client.get(action_key)
-        if "irregular_" in event.postback.data:
-            with client.transaction():
-                if "absence" in event.postback.data:
-                    action["when"] = event.postback.params['date']
-                else:
-                    action["when"] = event.postback.params['datetime']
-                client.put(action)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=words["askReason"]))
-        elif "others_" in event.postback.data:
-            with client.transaction():
-                action["category"] = event.postback.data[14:]
-                action["when"] = "NA"
-                client.put(action)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=words["askDescription"]))
-        elif event.postback.data == "action_submit_yes":
-            config_key = client.key("ConfigKind", "email")
-            configuration = client.get(config_key)
-            send_notice(
-                user["child_name"], user["grade"], user["classroom"],
-                action["category"], action["when"], action["description"],
-                configuration["email"])
-            sent_action_key = client.key(
-                "SentActionKind", event.timestamp, parent=user_key)
-            sent_action = datastore.Entity(key=sent_action_key)
-            sent_action.update(
-                {
-                    "child": user["child_name"],
-                    "grade": user["grade"],
-                    "classroom": user["classroom"],
-                    "category": action["category"],
-                    "when": action["when"],
-                    "description": action["description"],
-                    "registerd_date": str(datetime.date.today()),
-                    "createdAt": event.timestamp,
-                }
-            )
-            client.put(sent_action)
-            client.delete(action_key)
-            messages = [StickerSendMessage(package_id="11538", sticker_id="51626501"),
-                        TextSendMessage(text=words[action["category"] + "Sent"],
-                                        quick_reply=QuickReply(items=menu_buttons(words)))]
-            line_bot_api.reply_message(event.reply_token, messages)
-        elif event.postback.data == "action_cancel":
-            client.delete(action_key)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=words["cancelDone"],
-                                quick_reply=QuickReply(items=menu_buttons(words))))
-    elif "teacher_" in event.postback.data:
-        if "seeActions" in event.postback.data:
-            query = client.query(kind="SentActionKind")
-            if event.postback.data == "teacher_seeActionsByDate":
-                query.add_filter("registerd_date", "=",
-                                 event.postback.params['date'])
-            results = list(query.fetch())
-            if results:
-                notices = []
-                for result in results:
-                    child = result["child"]
-                    grade = result["grade"]
-                    classroom = result["classroom"]
-                    category = result["category"]
-                    when = result["when"]
-                    description = result["description"]
-                    time = datetime.datetime.fromtimestamp(
-                        result["createdAt"] / 1e3)
-                    notices.append(
-                        f"名前(Name): {child}, {grade}年(Grade), {classroom}組(Classroom), 種類(Category): {category}, 日時(When): {when}, 理由(Reason): {description}, 登録日時(Created at): {time}")
-                message = '\n\n'.join(notices)
-            else:
-                message = words["noResults"]
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=message, quick_reply=QuickReply(
-                    items=teacher_buttons(words))))
-        elif "seeUsers" in event.postback.data:
-            query = client.query(kind="UserKind")
-            results = list(query.fetch())
-            users = []
-            for result in results:
-                is_english = result["isEnglish"]
-                is_teacher = result["isTeacher"]
-                child_name = result["child_name"]
-                grade = result["grade"]
-                classroom = result["classroom"]
-                time = datetime.datetime.fromtimestamp(
-                    result["createdAt"] / 1e3)
-                users.append(
-                    f"名前：{child_name}、{grade}年 {classroom}組、Is English?:{is_english}、先生モード: {is_teacher}、登録日時: {time}")
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text='\n\n'.join(users), quick_reply=QuickReply(
-                    items=teacher_buttons(words))))
-        elif "setEmail" in event.postback.data:
-            config_key = client.key("ConfigKind", "email")
-            configuration = datastore.Entity(key=config_key)
-            configuration.update(
-                {
-                    "email": "",
-                    "createdAt": event.timestamp,
-                }
-            )
-            client.put(configuration)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=words["askEmail"]))
-        elif "deleteUser" in event.postback.data:
-            client.delete(user_key)
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=words["deleteUserDone"]))
-        elif "teacherOff" in event.postback.data:
-            with client.transaction():
-                user["isTeacher"] = False
-                client.put(user)
-            messages = [StickerSendMessage(
-                package_id="11538", sticker_id="51626494"),
-                TextSendMessage(text=words["teacherMode"] + ": OFF",
-                                quick_reply=QuickReply(items=menu_buttons(words)))]
-            line_bot_api.reply_message(event.reply_token, messages)
+        postback_routes.dispatch(event.postback.data, turn)
+
+
+def language_template(message):
+    confirm_template = ConfirmTemplate(text=message, actions=[
+        PostbackAction(label='日本語', data="language_japanese",
+                       display_text='日本語'),
+        PostbackAction(label='English',
+                       data="language_english", display_text='English'),
+    ])
+    return TemplateSendMessage(alt_text='Confirm language', template=confirm_template)
+
+
+@ message_routes.route("new")
+def ask_language(turn):
+    # until a language is chosen, typed text is looked up in the roster
+    user = datastore.Entity(key=turn.user_key)
+    user.update({
+        "child_name": "",
+        "grade": -1,
+        "classroom": -1,
+        "isEnglish": False,
+        "isTeacher": False,
+        "claiming": True,
+        "createdAt": turn.event.timestamp,
+    })
+    turn.session.put(user)
+    turn.reply(language_template("子どもの登録がまだっぽいので、お子さまの名前を入力するか、言語を選んでください。Seems like you haven't registered your child yet. Type your child's name, or select your language please."))
+
+
+@ message_routes.route("claimName")
+def ask_claim(turn):
+    entry = find_claimable(client, turn.event.message.text, turn.user_id)
+    if entry is None:
+        turn.reply(language_template("名簿に見つかりませんでした。名前をもう一度入力するか、言語を選んでください。Your child wasn't found in the school roster. Type the name again, or select your language please."))
+        return
+    words = english_words if entry["isEnglish"] else japanese_words
+    confirm_template = ConfirmTemplate(
+        text=words["confirmClaim"].format(
+            grade=entry["grade"], classroom=entry["classroom"],
+            child_name=entry["child_name"]), actions=[
+            PostbackAction(label=words["yes"], data=f"roster_{entry.key.name}",
+                           display_text=words["yes"]),
+            PostbackAction(label=words["cancel"], data="roster_no",
+                           display_text=words["cancel"]),
+        ])
+    template_message = TemplateSendMessage(
+        alt_text='Confirm child', template=confirm_template)
+    turn.reply(template_message)
+
+
+@ message_routes.route("registrationBroken")
+def registration_broken(turn):
+    turn.session.delete(turn.user_key)
+    turn.reply(turn.replies.bug_unregistered)
+
+
+@ message_routes.route("childName")
+def save_child_name(turn):
+    user = turn.user
+    user["child_name"] = turn.event.message.text
+    # registered by hand, but linked to the roster if the child is in it
+    entry = claim(client, roster_key(client, user["grade"], user["classroom"],
+                                     user["child_name"]), turn.user_id)
+    if entry is not None:
+        user["child_name"] = entry["child_name"]
+    turn.session.put(user)
+    turn.reply(turn.replies.register_completed)
+
+
+@ message_routes.route("actionBroken")
+def action_broken(turn):
+    turn.session.delete(turn.action_key)
+    turn.reply(turn.replies.bug)
+
+
+@ message_routes.route("broadcastText")
+def save_broadcast_text(turn):
+    words, action = turn.words, turn.action
+    action["description"] = turn.event.message.text
+    turn.session.put(action)
+    confirm_template = ConfirmTemplate(
+        text=f"{words['confirmBroadcast']}\n{action['description']}"[:240], actions=[
+            PostbackAction(label=words["yes"], data="teacher_broadcastSend",
+                           display_text=words["yes"]),
+            PostbackAction(label=words["cancel"], data="teacher_broadcastCancel",
+                           display_text=words["cancel"]),
+        ])
+    template_message = TemplateSendMessage(
+        alt_text='Confirm broadcast', template=confirm_template)
+    turn.reply(template_message)
+
+
+@ message_routes.route("description")
+def save_description(turn):
+    words, action = turn.words, turn.action
+    action["description"] = turn.event.message.text
+    turn.session.put(action)
+    confirm_submit = words["confirmSubmit"]
+    submit_type = words[action["category"]]
+    date_time = words["dateTime"]
+    when = action["when"]
+    description_key = words["description"]
+    description_value = action["description"]
+    if when == "NA":
+        message = f"{confirm_submit} {submit_type} {description_key}: {description_value}"
+    else:
+        message = f"{confirm_submit} {submit_type} {date_time}: {when}, {description_key}: {description_value}"
+    confirm_template = ConfirmTemplate(text=message, actions=[
+        PostbackAction(label=words["yes"], data="action_submit_yes",
+                       display_text=words["yes"]),
+        PostbackAction(label=words["cancel"], data="action_cancel",
+                       display_text=words["cancel"]),
+    ])
+    template_message = TemplateSendMessage(
+        alt_text='Confirm submit', template=confirm_template)
+    turn.reply(template_message)
+
+
+@ message_routes.route("teacherOn")
+def teacher_on(turn):
+    turn.user["isTeacher"] = True
+    turn.session.put(turn.user)
+    turn.reply(turn.replies.teacher_on)
+
+
+@ message_routes.route("email")
+def save_email(turn):
+    turn.configuration["email"] = turn.event.message.text
+    turn.session.put(turn.configuration)
+    turn.reply(turn.replies.set_email_done)
+
+
+@ message_routes.route("teacherOff")
+@ postback_routes.route("teacher_teacherOff")
+def teacher_off(turn):
+    turn.user["isTeacher"] = False
+    turn.session.put(turn.user)
+    turn.reply(turn.replies.teacher_off)
+
+
+@ message_routes.route("chat")
+def chat_reply(turn):
+    messages = []
+    torch_message = torchBot(turn.event.message.text)
+    messages.append(text(torch_message, turn.replies.menu))
+    if "I don't know" in torch_message:
+        messages.insert(0, turn.replies.dont_know)
+    turn.reply(messages)
+
+
+@ registration_routes.route("language_{}")
+def choose_language(turn, language):
+    turn.user["claiming"] = False
+    if language == "english":
+        turn.user["isEnglish"] = True
+        turn.set_language(True)
+    turn.session.put(turn.user)
+    turn.reply(turn.replies.ask_grade)
+
+
+@ registration_routes.route("roster_{int}_{int}_{}")
+def claim_child(turn, grade, classroom, name):
+    entry = claim(client, roster_key(client, grade, classroom, name), turn.user_id)
+    if entry is None:
+        # claimed by another parent since the confirm was shown
+        turn.reply(language_template("この名前はもう登録されています。言語を選んで登録してください。This child is already registered. Select your language to register please."))
+        return
+    user = turn.user
+    user.update({
+        "child_name": entry["child_name"],
+        "grade": entry["grade"],
+        "classroom": entry["classroom"],
+        "isEnglish": entry["isEnglish"],
+        "claiming": False,
+    })
+    turn.session.put(user)
+    turn.set_language(entry["isEnglish"])
+    turn.reply(turn.replies.register_completed)
+
+
+@ registration_routes.route("roster_no")
+def decline_claim(turn):
+    turn.reply(language_template("お子さまの名前をもう一度入力するか、言語を選んでください。Type your child's name again, or select your language please."))
+
+
+@ registration_routes.route("grade_{int}")
+def choose_grade(turn, grade):
+    turn.user["grade"] = grade
+    turn.session.put(turn.user)
+    turn.reply(turn.replies.ask_classroom)
+
+
+@ registration_routes.route("classroom_{int}")
+def choose_classroom(turn, classroom):
+    turn.user["classroom"] = classroom
+    turn.session.put(turn.user)
+    turn.reply(TextSendMessage(text=turn.words["childName"]))
+
+
+@ postback_routes.route("menu_{}")
+def choose_category(turn, category):
+    if category == "answerSubmit":
+        turn.reply(turn.replies.under_construction)
+        return
+    action = datastore.Entity(key=turn.action_key)
+    action.update(
+        {
+            "category": category,
+            "when": "",
+            "description": "",
+        }
+    )
+    turn.session.put(action)
+    turn.reply(turn.replies.proceed[category])
+
+
+@ postback_routes.route("action_irregular_{}")
+def choose_when(turn, category):
+    if category == "absence":
+        turn.action["when"] = turn.event.postback.params['date']
+    else:
+        turn.action["when"] = turn.event.postback.params['datetime']
+    turn.session.put(turn.action)
+    turn.reply(TextSendMessage(text=turn.words["askReason"]))
+
+
+@ postback_routes.route("action_others_{}")
+def choose_others(turn, category):
+    turn.action["category"] = category
+    turn.action["when"] = "NA"
+    turn.session.put(turn.action)
+    turn.reply(TextSendMessage(text=turn.words["askDescription"]))
+
+
+@ postback_routes.route("action_submit_yes")
+def submit_action(turn):
+    event, user, action, configuration = turn.event, turn.user, turn.action, turn.configuration
+    notice = {
+        "child_name": user["child_name"],
+        "grade": user["grade"],
+        "classroom": user["classroom"],
+        "category": action["category"],
+        "when": action["when"],
+        "description": action["description"],
+    }
+    digest_minutes = configuration.get("digestMinutes", 0)
+    if digest_minutes and action["category"] not in config.DIGEST_URGENT_CATEGORIES:
+        digest.add(configuration["email"], digest_minutes, **notice)
+    else:
+        outbox.enqueue(email_address=configuration["email"], **notice)
+    sent_action_key = client.key(
+        "SentActionKind", event.timestamp, parent=turn.user_key)
+    sent_action = datastore.Entity(key=sent_action_key)
+    sent_action.update(
+        {
+            "child": user["child_name"],
+            "grade": user["grade"],
+            "classroom": user["classroom"],
+            "category": action["category"],
+            "when": action["when"],
+            "description": action["description"],
+            "registerd_date": str(datetime.date.today()),
+            "createdAt": event.timestamp,
+        }
+    )
+    turn.session.put(sent_action)
+    turn.session.delete(turn.action_key)
+    turn.reply(turn.replies.sent[action["category"]])
+    increment(client, event.timestamp, user["grade"],
+              user["classroom"], action["category"])
+
+
+@ postback_routes.route("action_cancel")
+def cancel_action(turn):
+    turn.session.delete(turn.action_key)
+    turn.reply(turn.replies.cancel_done)
+
+
+@ postback_routes.route("teacher_seeActionsAll")
+@ postback_routes.route("teacher_seeActionsByDate")
+@ postback_routes.route(PAGE_PREFIX + ":{int}:{int}")
+def see_actions(turn, listing=None, page=0):
+    words = turn.words
+    page_key = client.key(PAGE_KIND, turn.user_id, parent=turn.user_key)
+    if listing is None:
+        listing = turn.event.timestamp
+        state = datastore.Entity(key=page_key, exclude_from_indexes=("cursors",))
+        state.update({"listing": listing, "start": None, "end": None, "cursors": []})
+        if turn.event.postback.data == "teacher_seeActionsByDate":
+            state["start"], state["end"] = day_range(turn.event.postback.params['date'])
+    else:
+        state, = turn.session.get_multi([page_key])
+        if state is None or state["listing"] != listing or not 0 < page <= len(state["cursors"]):
+            # a button of a list opened again since
+            turn.reply(text(words["pageExpired"], turn.replies.teacher))
+            return
+    cursor = state["cursors"][page - 1] if page else None
+    notices, next_cursor = fetch_page(client, state["start"], state["end"], cursor)
+    if notices:
+        texts = notice_texts(notices)
+    else:
+        texts = [words["noResults"]]
+    messages = [TextSendMessage(text=chunk) for chunk in texts]
+    if next_cursor:
+        state["cursors"] = state["cursors"][:page] + [next_cursor]
+        turn.session.put(state)
+        buttons = teacher_buttons(words)
+        buttons.insert(0, next_page_button(words, page_data(listing, page + 1)))
+        messages[-1].quick_reply = QuickReply(items=buttons)
+    else:
+        messages[-1].quick_reply = turn.replies.teacher
+    turn.reply(messages)
+
+
+@ postback_routes.route("teacher_todaySummary")
+def today_summary(turn):
+    today = local_date(turn.event.timestamp)
+    message = summary_text(daily_counts(client, today), turn.words)
+    turn.reply(text(f"{today}\n{message or turn.words['noResults']}", turn.replies.teacher))
+
+
+@ postback_routes.route("teacher_seeUsers")
+def see_users(turn):
+    query = client.query(kind="UserKind")
+    results = list(query.fetch())
+    users = []
+    for result in results:
+        is_english = result["isEnglish"]
+        is_teacher = result["isTeacher"]
+        child_name = result["child_name"]
+        grade = result["grade"]
+        classroom = result["classroom"]
+        time = datetime.datetime.fromtimestamp(
+            result["createdAt"] / 1e3)
+        users.append(
+            f"名前：{child_name}、{grade}年 {classroom}組、Is English?:{is_english}、先生モード: {is_teacher}、登録日時: {time}")
+    turn.reply(text('\n\n'.join(users), turn.replies.teacher))
+
+
+@ postback_routes.route("teacher_setEmail")
+def set_email(turn):
+    configuration = datastore.Entity(key=turn.config_key)
+    configuration.update(
+        {
+            "email": "",
+            "createdAt": turn.event.timestamp,
+        }
+    )
+    turn.session.put(configuration)
+    turn.reply(TextSendMessage(text=turn.words["askEmail"]))
+
+
+@ postback_routes.route("teacher_deleteUser")
+def delete_user(turn):
+    for key in user_keys(client, turn.user_id):
+        turn.session.delete(key)
+    turn.session.put(deleter.job(turn.user_id, turn.event.timestamp))
+    turn.session.commit()
+    deleter.submit(turn.user_id)
+    turn.reply(TextSendMessage(text=turn.words["deleteUserDone"]))
+
+
+@ postback_routes.route("teacher_digest")
+def toggle_digest(turn):
+    configuration = turn.configuration
+    digest_on = not configuration.get("digestMinutes", 0)
+    configuration["digestMinutes"] = config.DIGEST_MINUTES if digest_on else 0
+    turn.session.put(configuration)
+    turn.reply(text(turn.words["digest"] + (": ON" if digest_on else ": OFF"), turn.replies.teacher))
+
+
+@ postback_routes.route("teacher_broadcast")
+def broadcast_start(turn):
+    turn.reply(turn.replies.ask_broadcast_target[0])
+
+
+@ postback_routes.route("teacher_broadcastTo_{int}")
+@ postback_routes.route("teacher_broadcastTo_{int}_{int}")
+def broadcast_target(turn, grade, classroom=None):
+    if classroom is None:
+        turn.reply(turn.replies.ask_broadcast_target[grade])
+        return
+    action = datastore.Entity(key=turn.action_key)
+    action.update(
+        {
+            "category": "broadcast",
+            "when": "NA",
+            "description": "",
+            "grade": grade,
+            "classroom": classroom,
+        }
+    )
+    turn.session.put(action)
+    turn.reply(TextSendMessage(text=turn.words["askBroadcast"]))
+
+
+@ postback_routes.route("teacher_broadcastCancel")
+def broadcast_cancel(turn):
+    if turn.action:
+        turn.session.delete(turn.action_key)
+    turn.reply(turn.replies.teacher_cancel_done)
+
+
+@ postback_routes.route("teacher_broadcastSend")
+def broadcast_send(turn):
+    words, action = turn.words, turn.action
+    if not action or action["category"] != "broadcast" or not action["description"]:
+        # a stale confirm button
+        broadcast_cancel(turn)
+        return
+    user_ids = recipients(client, action["grade"], action["classroom"])
+    turn.session.delete(turn.action_key)
+    turn.reply(text(words["broadcastStarted"].format(total=len(user_ids)), turn.replies.teacher))
+    teacher_id = turn.user_id
+
+    def report(job):
+        line_sender.push_message(
+            teacher_id, TextSendMessage(text=words["broadcastDone"].format(**job)))
+
+    # an opaque id, /stats and the logs show it instead of the teacher's user ID
+    broadcaster.submit(str(uuid.uuid4()), user_ids,
+                       [TextSendMessage(text=action["description"])], report)
 
 
 @ handler.add(MessageEvent, message=StickerMessage)
+@ timed_event("sticker")
 def handle_sticker_message(event):
-    line_bot_api.reply_message(
-        event.reply_token,
-        StickerSendMessage(
-            package_id="11537",
-            sticker_id="52002753")
-    )
+    line_sender.reply_message(event.reply_token, STICKER_REPLY)
+
+
+@ handler.default()
+@ timed_event("other")
+def handle_other(event):
+    # follow, unfollow, ... are only counted
+    pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,276 @@
+import datetime
+import gzip
+import io
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from zoneinfo import ZoneInfo
+
+from google.cloud import datastore
+
+import config
+from data_export import CHUNK_SIZE, iter_entities
+
+INDEX_KIND = "ArchiveIndexKind"
+BLOB_KIND = "ArchiveBlobKind"
+DELETE_BATCH = 500
+# Datastore entities are limited to 1 MiB
+BLOB_CHUNK = 1000000
+
+
+class LocalArchiveStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    @contextmanager
+    def writer(self, name):
+        """
+        File to write an archive into, which only appears under its name once
+        the block exits without an error.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path + ".tmp", "wb") as file:
+                yield file
+        except BaseException:
+            os.remove(path + ".tmp")
+            raise
+        os.replace(path + ".tmp", path)
+
+    def open(self, name):
+        return open(os.path.join(self.directory, name), "rb")
+
+
+class BlobWriter:
+    """
+    File-like object putting an ArchiveBlobKind entity every BLOB_CHUNK
+    bytes, so at most one chunk is held in memory.
+    """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.chunks = 0
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= BLOB_CHUNK:
+            self._put(bytes(self._buffer[:BLOB_CHUNK]))
+            del self._buffer[:BLOB_CHUNK]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _put(self, data):
+        entity = datastore.Entity(
+            key=self.client.key(BLOB_KIND, f"{self.name}.{self.chunks}"),
+            exclude_from_indexes=("data",))
+        entity["data"] = data
+        self.client.put(entity)
+        self.chunks += 1
+
+    def close(self):
+        if self._buffer or not self.chunks:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        # written last, an archive without it was never finished
+        head = datastore.Entity(key=self.client.key(BLOB_KIND, self.name))
+        head["chunks"] = self.chunks
+        self.client.put(head)
+
+
+class BlobReader(io.RawIOBase):
+    """
+    Reads an archive written by BlobWriter, getting its ArchiveBlobKind
+    chunks one at a time as they are read.
+    """
+
+    def __init__(self, client, name):
+        super().__init__()
+        self.client = client
+        self.name = name
+        self.chunks = client.get(client.key(BLOB_KIND, name))["chunks"]
+        self._next = 0
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and self._next < self.chunks:
+            chunk = self.client.get(self.client.key(BLOB_KIND, f"{self.name}.{self._next}"))
+            self._buffer = memoryview(chunk["data"])
+            self._next += 1
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class DatastoreArchiveStore:
+    """
+    Stores each archive as ArchiveBlobKind entities of up to BLOB_CHUNK bytes,
+    named "<name>.<number>", and a "<name>" entity with the chunk count.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @contextmanager
+    def writer(self, name):
+        blob = BlobWriter(self.client, name)
+        yield blob
+        blob.close()
+
+    def open(self, name):
+        return BlobReader(self.client, name)
+
+
+def store_from_config(client):
+    if config.ARCHIVE_STORE == "datastore":
+        return DatastoreArchiveStore(client)
+    return LocalArchiveStore(config.ARCHIVE_STORE)
+
+
+def month_of(created_at):
+    return datetime.datetime.fromtimestamp(
+        created_at / 1e3, ZoneInfo(config.TIMEZONE)).strftime("%Y-%m")
+
+
+def month_range(month):
+    start = datetime.datetime.strptime(month, "%Y-%m").replace(
+        tzinfo=ZoneInfo(config.TIMEZONE))
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return int(start.timestamp() * 1e3), int(end.timestamp() * 1e3)
+
+
+def notice_record(entity):
+    record = dict(entity)
+    record["user_id"] = entity.key.parent.name if entity.key.parent else None
+    record["id"] = entity.key.id_or_name
+    return record
+
+
+def archive_month(client, store, month, cutoff):
+    """
+    Moves the month's notices created before cutoff into gzip JSON lines
+    archives and returns how many notices left SentActionKind.
+
+    The month's ArchiveIndexKind entity lists its parts and archivedUntil,
+    the createdAt every part so far was cut at. A new part holds the notices
+    from archivedUntil on and is named after it, so a run that failed before
+    updating the index writes the same part again. Notices before
+    archivedUntil are already archived and only deleted, which finishes the
+    deletes of a run that failed after updating the index.
+    """
+
+    start, end = month_range(month)
+    until = min(end, cutoff)
+    index_key = client.key(INDEX_KIND, month)
+    index = client.get(index_key) or datastore.Entity(key=index_key)
+    archived_until = index.get("archivedUntil", start)
+
+    count = 0
+    if archived_until < until:
+        query = client.query(kind="SentActionKind")
+        query.add_filter("createdAt", ">=", archived_until)
+        query.add_filter("createdAt", "<", until)
+        query.order = ["createdAt"]
+        name = f"notices-{month}.{archived_until}.jsonl.gz"
+        with store.writer(name) as file, gzip.GzipFile(fileobj=file, mode="wb") as archive:
+            for chunk in iter_entities(query):
+                for entity in chunk:
+                    archive.write(json.dumps(notice_record(entity),
+                                             ensure_ascii=False).encode("utf-8") + b"\n")
+                count += len(chunk)
+        if count:
+            index.update({
+                "month": month,
+                "parts": list(index.get("parts", [])) + [name],
+                "count": index.get("count", 0) + count,
+                "archivedUntil": until,
+                "archivedAt": int(time.time() * 1e3),
+            })
+            client.put(index)
+            archived_until = until
+
+    return delete_archived(client, start, archived_until)
+
+
+def delete_archived(client, start, until):
+    deleted = 0
+    while True:
+        query = client.query(kind="SentActionKind")
+        query.add_filter("createdAt", ">=", start)
+        query.add_filter("createdAt", "<", until)
+        query.keys_only()
+        keys = [entity.key for entity in query.fetch(limit=DELETE_BATCH)]
+        if not keys:
+            return deleted
+        client.delete_multi(keys)
+        deleted += len(keys)
+
+
+def compact(client, store, max_age_days=None):
+    """
+    Archives every notice older than max_age_days, one month at a time.
+    Returns {month: archived count}.
+    """
+
+    if max_age_days is None:
+        max_age_days = config.ARCHIVE_AFTER_DAYS
+    cutoff = int((time.time() - max_age_days * 86400) * 1e3)
+    archived = {}
+    while True:
+        query = client.query(kind="SentActionKind")
+        query.add_filter("createdAt", "<", cutoff)
+        query.order = ["createdAt"]
+        oldest = list(query.fetch(limit=1))
+        if not oldest:
+            return archived
+        month = month_of(oldest[0]["createdAt"])
+        count = archive_month(client, store, month, cutoff)
+        if not count:
+            return archived
+        archived[month] = archived.get(month, 0) + count
+
+
+def archived_months(client):
+    return [index["month"] for index in client.query(kind=INDEX_KIND).fetch()]
+
+
+def iter_archived(client, store, month, chunk_size=CHUNK_SIZE):
+    """
+    Yields the archived notices of a month in chunks, like
+    data_export.iter_entities. Parts are decompressed as they are read, so
+    only one chunk of notices is held in memory.
+    """
+
+    index = client.get(client.key(INDEX_KIND, month))
+    if index is None:
+        return
+    chunk = []
+    for name in index["parts"]:
+        with store.open(name) as file, gzip.GzipFile(fileobj=file, mode="rb") as archive:
+            for line in archive:
+                if line.strip():
+                    chunk.append(json.loads(line))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+if __name__ == "__main__":
+    datastore_client = datastore.Client()
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    for archived_month, count in compact(
+            datastore_client, store_from_config(datastore_client), days).items():
+        print(f"archived {count} notices of {archived_month}")
@@ -0,0 +1,184 @@
+"""
+ASGI entry point, run with e.g. `uvicorn asgi:app`.
+
+Uses the same handle_message / handle_postback functions as app:app. Each
+event runs in a thread pool (Datastore calls stay blocking there), events of
+the same LINE user run in order, and LINE reply/push calls go out through
+aiohttp on the event loop instead of blocking a thread. Every other route
+(/export, /import/roster, /stats, /metrics, ...) is served by the Flask app
+itself through a2wsgi's WSGI adapter.
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from a2wsgi import WSGIMiddleware
+from linebot import AsyncLineBotApi
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError
+
+import app as flask_app
+import config
+from line_http import LINE_ERRORS, LINE_SECONDS
+from webhook_executor import dispatch, event_key
+
+log = logging.getLogger(__name__)
+
+# the same LINE API metrics PooledHttpClient records, for the aiohttp client
+ENDPOINT_METRICS = {
+    name: (LINE_SECONDS.labels(path), LINE_ERRORS.labels(path))
+    for name, path in [("reply", "/v2/bot/message/reply"),
+                       ("push", "/v2/bot/message/push"),
+                       ("multicast", "/v2/bot/message/multicast")]}
+
+
+class LoopLineBotApi:
+    """
+    Stands in for LineBotApi inside the handler threads: reply and push are
+    scheduled on the event loop and the thread moves on.
+    """
+
+    def __init__(self, async_api, loop):
+        self.async_api = async_api
+        self.loop = loop
+
+    def _schedule(self, coroutine, endpoint):
+        future = asyncio.run_coroutine_threadsafe(
+            _timed(coroutine, *ENDPOINT_METRICS[endpoint]), self.loop)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def reply_message(self, reply_token, messages, notification_disabled=False,
+                      timeout=None):
+        self._schedule(self.async_api.reply_message(
+            reply_token, messages, notification_disabled=notification_disabled,
+            timeout=timeout), "reply")
+
+    def push_message(self, to, messages, retry_key=None,
+                     notification_disabled=False, timeout=None):
+        self._schedule(self.async_api.push_message(
+            to, messages, retry_key=retry_key,
+            notification_disabled=notification_disabled, timeout=timeout), "push")
+
+    def multicast(self, to, messages, retry_key=None,
+                  notification_disabled=False, timeout=None):
+        self._schedule(self.async_api.multicast(
+            to, messages, retry_key=retry_key,
+            notification_disabled=notification_disabled, timeout=timeout), "multicast")
+
+
+async def _timed(coroutine, seconds, errors):
+    with seconds.time(errors):
+        return await coroutine
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        log.error("LINE API call failed", exc_info=future.exception())
+
+
+class WebhookApp:
+    def __init__(self, handler, threads, wsgi_app, wsgi_threads=10):
+        self.handler = handler
+        # its own threads, so a long export doesn't hold up webhook events
+        self.wsgi = WSGIMiddleware(wsgi_app, workers=wsgi_threads)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.session = None
+        self._tails = {}
+
+    async def startup(self):
+        self.session = aiohttp.ClientSession()
+        flask_app.use_line_sender(LoopLineBotApi(
+            AsyncLineBotApi(config._LINE_TOKEN,
+                            AiohttpAsyncHttpClient(self.session)),
+            asyncio.get_running_loop()))
+
+    async def shutdown(self):
+        tails = list(self._tails.values())
+        if tails:
+            await asyncio.wait(tails, timeout=config.WEBHOOK_DRAIN_SECONDS)
+        await self.session.close()
+        self.pool.shutdown(wait=False)
+
+    def submit(self, event):
+        key = event_key(event)
+        task = asyncio.ensure_future(self._run_after(self._tails.get(key), event))
+        self._tails[key] = task
+        task.add_done_callback(lambda done: self._forget(key, done))
+
+    def _forget(self, key, task):
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _run_after(self, previous, event):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.pool, dispatch, self.handler, event)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("webhook event failed")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        if scope["path"] != "/callback" or scope["method"] != "POST":
+            await self.wsgi(scope, receive, send)
+            return
+        body = await read_body(receive)
+        headers = dict(scope["headers"])
+        signature = headers.get(b"x-line-signature", b"").decode()
+        # the same request metrics as app.callback
+        flask_app.WEBHOOK_IN_FLIGHT.inc()
+        try:
+            with flask_app.WEBHOOK_SECONDS.time(flask_app.WEBHOOK_ERRORS):
+                payload = self.handler.parser.parse(
+                    body.decode("utf-8"), signature, as_payload=True)
+                for event in payload.events:
+                    self.submit(event)
+        except InvalidSignatureError:
+            print("Invalid signature. Please check your channel access token/channel secret.")
+            await respond(send, 400, b"Bad Request")
+            return
+        finally:
+            flask_app.WEBHOOK_IN_FLIGHT.dec()
+        await respond(send, 200, b"OK")
+
+
+async def read_body(receive):
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def respond(send, status, body):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+app = WebhookApp(flask_app.handler, config.ASGI_THREADS, flask_app.app,
+                 config.ASGI_WSGI_THREADS)
@@ -0,0 +1,69 @@
+import re
+import timeit
+from email.message import EmailMessage
+from send_email import build_notice, render_notice
+
+NOTICE = ("山田 太郎", 3, 2, "tardiness", "2020-12-01T08:30",
+          "病院に寄ってから登校します")
+
+# the HTML build_notice used to concatenate on every call, between its fields
+with open('templates/notice.html', encoding='utf-8') as template:
+    HTML = re.split(r"\$\{\w+\}", template.read())
+
+
+def old_render_notice(child_name, grade, classroom, category, when, description):
+    # send_email.build_notice before the precompiled template
+    if category == "absence":
+        email_category = "欠席"
+    elif category == "tardiness":
+        email_category = "遅刻"
+    elif category == "leave_early":
+        email_category = "早退"
+    elif category == "contact":
+        email_category = "連絡"
+    elif category == "question":
+        email_category = "質問"
+    elif category == "consult":
+        email_category = "相談"
+    elif category == "answer":
+        email_category = "回答"
+    elif category == "fileSubmit":
+        email_category = "提出"
+    elif category == "technical":
+        email_category = "このアプリに関する質問"
+    elif category == "others":
+        email_category = "その他の連絡"
+    else:
+        email_category = "No Category"
+    html = (HTML[0] + str(email_category) + HTML[1] + str(child_name) + HTML[2]
+            + str(grade) + HTML[3] + str(classroom) + HTML[4] + str(email_category)
+            + HTML[5] + str(when) + HTML[6] + str(email_category) + HTML[7]
+            + str(description) + HTML[8])
+    return f"{email_category} Notice", f"{email_category} Notice", html
+
+
+def old_build_notice(child_name, grade, classroom, category, when, description, email_address):
+    subject, text, html = old_render_notice(
+        child_name, grade, classroom, category, when, description)
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = "bayezid1989@live.jp"
+    msg['To'] = email_address
+    msg.set_content(text)
+    msg.add_alternative(html, subtype='html')
+    return msg
+
+
+def bench(number=2000):
+    assert old_render_notice(*NOTICE) == render_notice(*NOTICE)
+    for name, func in [
+            ("render_notice before", lambda: old_render_notice(*NOTICE)),
+            ("render_notice after", lambda: render_notice(*NOTICE)),
+            ("build_notice before", lambda: old_build_notice(*NOTICE, "teacher@example.com")),
+            ("build_notice after", lambda: build_notice(*NOTICE, "teacher@example.com"))]:
+        seconds = timeit.timeit(func, number=number)
+        print(f"{name}: {seconds / number * 1e6:.1f} us per notice")
+
+
+if __name__ == "__main__":
+    bench()
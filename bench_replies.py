@@ -0,0 +1,44 @@
+import json
+import timeit
+import tracemalloc
+
+from linebot.models import QuickReply, StickerSendMessage, TextSendMessage
+
+from quick_buttons import menu_buttons
+from replies import Replies
+
+with open('language/japanese.json') as japanese:
+    WORDS = json.load(japanese)
+REPLIES = Replies(WORDS)
+
+
+def built():
+    return [StickerSendMessage(package_id="11538", sticker_id="51626501"),
+            TextSendMessage(text=WORDS["absenceSent"],
+                            quick_reply=QuickReply(items=menu_buttons(WORDS)))]
+
+
+def precomputed():
+    return REPLIES.sent["absence"]
+
+
+def serialize(messages):
+    # what LineBotApi.reply_message does with the messages
+    return json.dumps({"replyToken": "r",
+                       "messages": [message.as_json_dict() for message in messages]})
+
+
+def bench(number=5000):
+    assert serialize(built()) == serialize(precomputed())
+    for name, func in [("built", built), ("precomputed", precomputed)]:
+        seconds = timeit.timeit(lambda: serialize(func()), number=number)
+        tracemalloc.start()
+        serialize(func())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name}: {seconds / number * 1e6:.1f} us, "
+              f"{peak / 1024:.1f} KiB peak per reply")
+
+
+if __name__ == "__main__":
+    bench()
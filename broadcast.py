@@ -0,0 +1,156 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot.exceptions import LineBotApiError
+from linebot.models.error import Error
+
+log = logging.getLogger(__name__)
+
+# LINE accepts at most 500 user IDs per multicast request
+CHUNK_SIZE = 500
+
+
+def recipients(client, grade=0, classroom=0):
+    """
+    User IDs of the registered parents of a classroom, a grade (classroom 0)
+    or the whole school (grade 0), from a keys-only UserKind query.
+    """
+
+    query = client.query(kind="UserKind")
+    if grade:
+        query.add_filter("grade", "=", grade)
+        if classroom:
+            query.add_filter("classroom", "=", classroom)
+    else:
+        query.add_filter("grade", ">=", 1)
+    query.keys_only()
+    return [entity.key.name for entity in query.fetch()]
+
+
+class Throttle:
+    """
+    Spaces request starts across all threads to at most `rate` per second.
+    A 429 answer pauses everybody for `pause` seconds, doubling on each
+    further 429 up to max_pause.
+    """
+
+    def __init__(self, rate, pause=1.0, max_pause=60.0):
+        self.interval = 1.0 / rate
+        self.pause = pause
+        self.max_pause = max_pause
+        self._penalty = 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(max(0.0, start - now))
+
+    def limited(self):
+        with self._lock:
+            self._penalty = min(self._penalty * 2 or self.pause, self.max_pause)
+            self._next = max(self._next, time.monotonic() + self._penalty)
+
+    def ok(self):
+        self._penalty = 0.0
+
+
+class Broadcaster:
+    """
+    Sends one set of messages to many users with the multicast API,
+    CHUNK_SIZE users per request and `workers` requests in flight.
+
+    Each chunk carries its own X-Line-Retry-Key, so 429 and 5xx answers are
+    retried without risk of a parent getting the message twice (LINE answers
+    409 for a key it already accepted). LineBotApi.multicast would keep that
+    header on the shared client, so the request is built here instead.
+    """
+
+    def __init__(self, line_bot_api, workers=4, rate=20, max_attempts=5):
+        self.line_bot_api = line_bot_api
+        self.max_attempts = max_attempts
+        self.throttle = Throttle(rate)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._progress = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job_id, user_ids, messages, done=None):
+        """
+        Starts sending in the background and returns the number of chunks.
+        done(job) is called from a worker thread once every chunk finished.
+        """
+
+        chunks = [user_ids[i:i + CHUNK_SIZE]
+                  for i in range(0, len(user_ids), CHUNK_SIZE)]
+        job = {"total": len(user_ids), "sent": 0, "failed": 0,
+               "chunks": len(chunks), "pending": len(chunks)}
+        with self._lock:
+            self._progress[job_id] = job
+        if not chunks:
+            self._finish(job_id, done)
+        messages = [message.as_json_dict() for message in messages]
+        for chunk in chunks:
+            self._pool.submit(self._run, job_id, chunk, messages, done)
+        return len(chunks)
+
+    def progress(self):
+        with self._lock:
+            return {job_id: dict(job) for job_id, job in self._progress.items()}
+
+    def _run(self, job_id, chunk, messages, done):
+        try:
+            self.multicast(chunk, messages)
+            sent = True
+        except Exception:  # pylint: disable=broad-except
+            log.exception("multicast of %s to %d users failed", job_id, len(chunk))
+            sent = False
+        with self._lock:
+            job = self._progress[job_id]
+            job["sent" if sent else "failed"] += len(chunk)
+            job["pending"] -= 1
+            finished = job["pending"] == 0
+        if finished:
+            self._finish(job_id, done)
+
+    def _finish(self, job_id, done):
+        with self._lock:
+            job = self._progress.pop(job_id)
+        if done is not None:
+            try:
+                done(job)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("broadcast report of %s failed", job_id)
+
+    def multicast(self, user_ids, messages):
+        api = self.line_bot_api
+        body = json.dumps({"to": user_ids, "messages": messages})
+        headers = {"Content-Type": "application/json"}
+        headers.update(api.headers)
+        headers["X-Line-Retry-Key"] = str(uuid.uuid4())
+        for attempt in range(1, self.max_attempts + 1):
+            self.throttle.wait()
+            response = api.http_client.post(
+                api.endpoint + "/v2/bot/message/multicast",
+                headers=headers, data=body)
+            if 200 <= response.status_code < 300 or response.status_code == 409:
+                self.throttle.ok()
+                return
+            if response.status_code == 429:
+                self.throttle.limited()
+            elif response.status_code < 500 or attempt == self.max_attempts:
+                break
+            else:
+                time.sleep(min(2 ** attempt, 30))
+        raise LineBotApiError(
+            status_code=response.status_code,
+            headers=dict(response.headers.items()),
+            request_id=response.headers.get("X-Line-Request-Id"),
+            accepted_request_id=response.headers.get("X-Line-Accepted-Request-Id"),
+            error=Error.new_from_json_dict(response.json))
@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import datastore
+
+from teacher_notices import PAGE_KIND
+
+log = logging.getLogger(__name__)
+
+JOB_KIND = "DeleteJobKind"
+BATCH_SIZE = 500
+
+
+# kinds stored under a UserKind with one entity named after the user
+SINGLE_KINDS = ("ActionKind", PAGE_KIND)
+
+
+def user_keys(client, user_id):
+    """
+    The UserKind key and the keys of its SINGLE_KINDS children, deleted
+    together when a user is deleted.
+    """
+
+    user_key = client.key("UserKind", user_id)
+    return [user_key] + [client.key(kind, user_id, parent=user_key)
+                         for kind in SINGLE_KINDS]
+
+
+class CascadeDeleter:
+    """
+    Deletes the SentActionKind notices stored under a deleted UserKind in
+    the background, BATCH_SIZE keys at a time from keys-only ancestor
+    queries.
+
+    Only notices created before the job are deleted, so a parent who
+    registers again while the job runs keeps their new notices. The job
+    ends by deleting whatever is left of the user itself, unless it was
+    created again in the meantime.
+
+    Each user has a DeleteJobKind entity holding its status and deleted
+    count, so jobs interrupted by a restart are picked up again by resume().
+    The user's keys are dropped from the EntityCache, if given, after the
+    final delete.
+    """
+
+    def __init__(self, client, cache=None, batch_size=BATCH_SIZE):
+        self.client = client
+        self.cache = cache
+        self.batch_size = batch_size
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._progress = {}
+        self._lock = threading.Lock()
+
+    def job(self, user_id, timestamp):
+        """
+        New job entity, to be written together with the deletion of the user
+        entity itself before calling submit.
+        """
+
+        job = datastore.Entity(key=self.client.key(JOB_KIND, user_id))
+        job.update({"status": "running", "deleted": 0, "createdAt": timestamp})
+        return job
+
+    def submit(self, user_id):
+        with self._lock:
+            self._progress[user_id] = 0
+        self._pool.submit(self._run, user_id)
+
+    def resume(self):
+        self._pool.submit(self._resume)
+
+    def _resume(self):
+        query = self.client.query(kind=JOB_KIND)
+        query.add_filter("status", "=", "running")
+        for job in query.fetch():
+            self.submit(job.key.name)
+
+    def progress(self):
+        with self._lock:
+            return dict(self._progress)
+
+    def _run(self, user_id):
+        try:
+            self.delete_descendants(user_id)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("deleting data of %s failed", user_id)
+        with self._lock:
+            self._progress.pop(user_id, None)
+
+    def delete_descendants(self, user_id):
+        user_key, *single_keys = user_keys(self.client, user_id)
+        job_key = self.client.key(JOB_KIND, user_id)
+        job = self.client.get(job_key) or self.job(user_id, int(time.time() * 1e3))
+        while True:
+            query = self.client.query(kind="SentActionKind", ancestor=user_key)
+            query.add_filter("createdAt", "<", job["createdAt"])
+            query.keys_only()
+            keys = [entity.key for entity in query.fetch(limit=self.batch_size)]
+            if not keys:
+                break
+            self.client.delete_multi(keys)
+            job["deleted"] += len(keys)
+            self.client.put(job)
+            with self._lock:
+                self._progress[user_id] = job["deleted"]
+        with self.client.transaction():
+            # a parent registering again conflicts with this transaction
+            user = self.client.get(user_key)
+            if user is None or user.get("createdAt", 0) < job["createdAt"]:
+                self.client.delete_multi([user_key] + single_keys)
+        if self.cache is not None:
+            for key in [user_key] + single_keys:
+                self.cache.invalidate(key)
+        job["status"] = "done"
+        self.client.put(job)
+        return job["deleted"]
@@ -1,42 +1,163 @@
+import os
 import random
 import json
-import torch
-from model import NeuralNet
-from nltk_utils import bag_of_words, tokenize
-
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+import numpy as np
+import config
+import numpy_model
+from batcher import MicroBatcher
+from metrics import REGISTRY
+from nltk_utils import tokenize, word_index, word_indices
 
 with open('intents.json', 'r') as file:
     intents = json.load(file)
-FILE = "data.pth"
-data = torch.load(FILE)
+FILE = "data.npz"
 
-input_size = data["input_size"]
-hidden_size = data["hidden_size"]
-output_size = data["output_size"]
-all_words = data["all_words"]
-tags = data["tags"]
-model_state = data["model_state"]
+INFERENCE_SECONDS = REGISTRY.histogram(
+    "chat_inference_seconds", "torchBot intent prediction latency, cache hits included").labels()
+INFERENCE_ERRORS = REGISTRY.counter(
+    "chat_inference_errors_total", "torchBot predictions that raised").labels()
+CACHE_LOOKUPS = REGISTRY.counter(
+    "chat_cache_lookups_total", "torchBot prediction cache lookups, across model reloads",
+    ["result"])
+CACHE_HITS = CACHE_LOOKUPS.labels("hit")
+CACHE_MISSES = CACHE_LOOKUPS.labels("miss")
+CACHE_SIZE = REGISTRY.gauge(
+    "chat_cache_entries", "Predictions held by the current model's cache").labels()
 
-model = NeuralNet(input_size, hidden_size, output_size).to(device)
-model.load_state_dict(model_state)
-model.eval()
 
+def classify_batch(items):
+    """
+    Runs (snapshot, indices) items through the model of their snapshot, one
+    forward pass per snapshot in the batch.
+    """
+
+    groups = {}
+    for position, (current, _) in enumerate(items):
+        groups.setdefault(id(current), (current, []))[1].append(position)
+    results = [None] * len(items)
+    for current, positions in groups.values():
+        predictions = current.classify([items[position][1] for position in positions])
+        for position, prediction in zip(positions, predictions):
+            results[position] = prediction
+    return results
+
+
+if config.INFERENCE_BATCH_SIZE > 1:
+    batcher = MicroBatcher(classify_batch, config.INFERENCE_BATCH_SIZE,
+                           config.INFERENCE_BATCH_WAIT_MS / 1e3)
+else:
+    batcher = None
+
+
+def classify(current, indices):
+    if batcher is None:
+        return current.classify([indices])[0]
+    return batcher.submit((current, indices))
+
+
+class PredictionCache:
+    """
+    LRU cache of (tag, prob) keyed on the vocabulary columns of a message.
+    Hits and misses go to the chat_cache_lookups_total counters, which
+    outlive the cache of a reloaded model.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            prediction = self._entries.get(key)
+            if prediction is None:
+                CACHE_MISSES.inc()
+                return None
+            self._entries.move_to_end(key)
+            CACHE_HITS.inc()
+            return prediction
+
+    def put(self, key, prediction):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = prediction
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def size(self):
+        return len(self._entries)
 
-def torchBot(sentence):
-    sentence = tokenize(sentence)
-    X = bag_of_words(sentence, all_words)
-    X = X.reshape(1, X.shape[0])
-    X = torch.from_numpy(X).to(device)
 
-    output = model(X)
-    _, predicted = torch.max(output, dim=1)
+class Snapshot(NamedTuple):
+    """
+    One loaded data.npz with its vocabulary and prediction cache. A reload
+    replaces the whole snapshot, so a prediction that started on the old one
+    keeps using its model, vocabulary and cache to the end.
+    """
 
-    tag = tags[predicted.item()]
+    mtime: float
+    model: numpy_model.NumpyNeuralNet
+    tags: list
+    words_index: dict
+    cache: PredictionCache
 
-    probs = torch.softmax(output, dim=1)
-    prob = probs[0][predicted.item()]
-    if prob.item() > 0.75:
+    def classify(self, index_lists):
+        probs = numpy_model.softmax(self.model.forward_indices(index_lists))
+        predicted = probs.argmax(axis=1)
+        prob = probs[np.arange(len(predicted)), predicted]
+        return [(self.tags[index], p) for index, p in zip(predicted.tolist(), prob.tolist())]
+
+
+def load_snapshot():
+    mtime = os.stat(FILE).st_mtime
+    model, all_words, tags = numpy_model.load(FILE)
+    return Snapshot(mtime, model, tags, word_index(all_words),
+                    PredictionCache(config.CHAT_CACHE_SIZE))
+
+
+snapshot = load_snapshot()
+reload_lock = threading.Lock()
+CACHE_SIZE.function = lambda: snapshot.cache.size()
+
+
+def cache_stats():
+    return {"hits": CACHE_HITS.value, "misses": CACHE_MISSES.value,
+            "size": snapshot.cache.size()}
+
+
+def reload_if_changed():
+    global snapshot
+    if os.stat(FILE).st_mtime == snapshot.mtime:
+        return
+    with reload_lock:
+        if os.stat(FILE).st_mtime != snapshot.mtime:
+            snapshot = load_snapshot()
+
+
+def predict(sentence):
+    reload_if_changed()
+    current = snapshot
+    indices = word_indices(tokenize(sentence), current.words_index)
+    prediction = current.cache.get(indices)
+    if prediction is None:
+        prediction = classify(current, indices)
+        current.cache.put(indices, prediction)
+    return prediction
+
+
+def torchBot(sentence):
+    with INFERENCE_SECONDS.time(INFERENCE_ERRORS):
+        tag, prob = predict(sentence)
+    if prob > 0.75:
         for intent in intents['intents']:
             if tag == intent["tag"]:
                 return random.choice(intent['responses'])
@@ -9,3 +9,84 @@ _LINE_SECRET = os.getenv('_LINE_SECRET')
 # Email
 EMAIL_USER = os.getenv('MAILJET_USER')
 EMAIL_PASS = os.getenv('MAILJET_PASS')
+
+# Chat inference batching
+INFERENCE_BATCH_SIZE = int(os.getenv('INFERENCE_BATCH_SIZE', '32'))
+INFERENCE_BATCH_WAIT_MS = float(os.getenv('INFERENCE_BATCH_WAIT_MS', '2'))
+CHAT_CACHE_SIZE = int(os.getenv('CHAT_CACHE_SIZE', '1024'))
+
+# Tokenizer used by nltk_utils.tokenize: "regex" or "nltk"
+TOKENIZER = os.getenv('TOKENIZER', 'regex')
+
+# Cloud Run sets K_SERVICE. Its filesystem is in memory, so the outbox and
+# digest databases must be given a persistent volume there (see README).
+ON_CLOUD_RUN = 'K_SERVICE' in os.environ
+
+# Email outbox
+OUTBOX_PATH = os.getenv('OUTBOX_PATH') or (None if ON_CLOUD_RUN else 'outbox.sqlite3')
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '2'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_BACKOFF_SECONDS = float(os.getenv('OUTBOX_BACKOFF_SECONDS', '5'))
+# sent notices are deleted from the outbox after this many days
+OUTBOX_RETENTION_DAYS = float(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
+
+# SMTP
+SMTP_HOST = os.getenv('SMTP_HOST', 'in-v3.mailjet.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', '2'))
+SMTP_IDLE_TIMEOUT = float(os.getenv('SMTP_IDLE_TIMEOUT', '60'))
+
+# Teacher digest emails
+DIGEST_MINUTES = int(os.getenv('DIGEST_MINUTES', '15'))
+DIGEST_URGENT_CATEGORIES = [
+    category for category in os.getenv('DIGEST_URGENT_CATEGORIES', '').split(',')
+    if category]
+DIGEST_PATH = os.getenv('DIGEST_PATH') or (None if ON_CLOUD_RUN else 'digest.sqlite3')
+
+# Webhook processing: 0 workers handles events inside the request,
+# otherwise they run on a background pool after answering LINE
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '0'))
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', '256'))
+WEBHOOK_DRAIN_SECONDS = float(os.getenv('WEBHOOK_DRAIN_SECONDS', '8'))
+
+# ASGI entry point (asgi:app)
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', '32'))
+# threads running the Flask routes other than /callback under asgi:app
+ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', '10'))
+
+# Cache for UserKind / ActionKind / ConfigKind entities
+ENTITY_CACHE_SIZE = int(os.getenv('ENTITY_CACHE_SIZE', '2048'))
+ENTITY_CACHE_TTL = float(os.getenv('ENTITY_CACHE_TTL', '300'))
+# re-read cached entities older than this (seconds) to pick up writes from
+# other instances. Set it when running more than one instance; with a single
+# instance ("off") every write goes through its write-through cache.
+ENTITY_CACHE_VERIFY_AFTER = os.getenv('ENTITY_CACHE_VERIFY_AFTER', 'off')
+ENTITY_CACHE_VERIFY_AFTER = (None if ENTITY_CACHE_VERIFY_AFTER == 'off'
+                             else float(ENTITY_CACHE_VERIFY_AFTER))
+
+# Teacher notice lists and daily counts
+TIMEZONE = os.getenv('TIMEZONE', 'Asia/Tokyo')
+TEACHER_PAGE_SIZE = int(os.getenv('TEACHER_PAGE_SIZE', '20'))
+DAILY_COUNT_SHARDS = int(os.getenv('DAILY_COUNT_SHARDS', '4'))
+
+# bearer token for /export, /import and /stats, the endpoints are disabled when unset
+EXPORT_TOKEN = os.getenv('EXPORT_TOKEN')
+
+# Archiving of old SentActionKind notices (python archive.py)
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '180'))
+# "datastore" or a local directory
+ARCHIVE_STORE = os.getenv('ARCHIVE_STORE', 'datastore')
+
+# POST /import/roster (same bearer token as /export)
+ROSTER_IMPORT_WORKERS = int(os.getenv('ROSTER_IMPORT_WORKERS', '8'))
+
+# HTTP connections to the LINE API
+LINE_POOL_SIZE = int(os.getenv('LINE_POOL_SIZE', '10'))
+LINE_CONNECT_TIMEOUT = float(os.getenv('LINE_CONNECT_TIMEOUT', '3'))
+LINE_READ_TIMEOUT = float(os.getenv('LINE_READ_TIMEOUT', '10'))
+LINE_RETRIES = int(os.getenv('LINE_RETRIES', '2'))
+
+# teacher broadcasts (LINE multicast, 500 parents per request)
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '4'))
+# multicast requests per second, LINE allows 200
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '20'))
@@ -0,0 +1,28 @@
+def message_state(turn):
+    """
+    Name of the message_routes route a text message goes to, from the
+    entities of its Turn: the user's registration, a notice or broadcast
+    being written, and teacher mode.
+    """
+
+    user, action = turn.user, turn.action
+    if user is None:
+        return "new"
+    if user["child_name"] == "":
+        if user.get("claiming"):
+            return "claimName"
+        return "registrationBroken" if user["classroom"] == -1 else "childName"
+    if action:
+        if action["when"] == "":
+            return "actionBroken"
+        if action["category"] == "broadcast":
+            return "broadcastText"
+        if action["description"] == "":
+            return "description"
+        # waiting for the confirm buttons, text is ignored
+        return "confirming"
+    if turn.event.message.text == "Teacher on":
+        return "teacherOn"
+    if user["isTeacher"] is True:
+        return "email" if turn.configuration["email"] == "" else "teacherOff"
+    return "chat"
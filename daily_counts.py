@@ -0,0 +1,117 @@
+import datetime
+import random
+import sys
+from collections import Counter
+from zoneinfo import ZoneInfo
+
+from google.cloud import datastore
+
+import config
+from teacher_notices import day_range
+
+KIND = "DailyCountKind"
+
+
+def local_date(created_at):
+    return datetime.datetime.fromtimestamp(
+        created_at / 1e3, ZoneInfo(config.TIMEZONE)).date().isoformat()
+
+
+def counter_name(grade, classroom, category):
+    return f"{grade}_{classroom}_{category}"
+
+
+def shard_keys(client, date):
+    return [client.key(KIND, f"{date}_{shard}")
+            for shard in range(config.DAILY_COUNT_SHARDS)]
+
+
+def increment(client, created_at, grade, classroom, category):
+    """
+    Adds one notice to the day's counters. The day is split into
+    DAILY_COUNT_SHARDS entities and a random one is updated, so parallel
+    submits rarely contend on the same entity. Counters are not indexed, so
+    a new grade/classroom/category adds no index writes.
+    """
+
+    date = local_date(created_at)
+    key = random.choice(shard_keys(client, date))
+    name = counter_name(grade, classroom, category)
+    with client.transaction():
+        counter = client.get(key)
+        if counter is None:
+            counter = datastore.Entity(key=key)
+            counter["date"] = date
+        counter[name] = counter.get(name, 0) + 1
+        counter.exclude_from_indexes.add(name)
+        client.put(counter)
+
+
+def daily_counts(client, date):
+    """
+    {(grade, classroom, category): count} for a "YYYY-MM-DD" date, read with
+    one get_multi over the day's shards.
+    """
+
+    counts = Counter()
+    for counter in client.get_multi(shard_keys(client, date)):
+        for name, value in counter.items():
+            if name == "date":
+                continue
+            grade, classroom, category = name.split("_", 2)
+            counts[(int(grade), int(classroom), category)] += value
+    return counts
+
+
+def summary_text(counts, words):
+    classes = {}
+    for (grade, classroom, category), count in sorted(counts.items()):
+        classes.setdefault((grade, classroom), []).append(
+            f"{words.get(category, category)} {count}")
+    return "\n".join(f"{grade}年 {classroom}組: " + ", ".join(categories)
+                     for (grade, classroom), categories in classes.items())
+
+
+def add_notices(totals, notices):
+    for notice in notices:
+        totals.setdefault(local_date(notice["createdAt"]), Counter())[counter_name(
+            notice["grade"], notice["classroom"], notice["category"])] += 1
+
+
+def rebuild(client, dates=None):
+    """
+    Recomputes the counters from SentActionKind, for the given dates or for
+    every date with notices. Run with `python daily_counts.py [YYYY-MM-DD ...]`.
+
+    A day's counters are overwritten with the counts read here and its other
+    shards deleted, with no lock against increment: notices submitted for
+    that day while rebuild runs are lost from the counters. Rebuild past
+    days, or today only when no parent is submitting.
+    """
+
+    totals = {}
+    if dates:
+        # only the requested days are read, with a createdAt range each
+        for date in sorted(set(dates)):
+            start, end = day_range(date)
+            query = client.query(kind="SentActionKind")
+            query.add_filter("createdAt", ">=", start)
+            query.add_filter("createdAt", "<", end)
+            add_notices(totals, query.fetch())
+            totals.setdefault(date, Counter())
+    else:
+        add_notices(totals, client.query(kind="SentActionKind").fetch())
+    for date, counts in totals.items():
+        first, *others = shard_keys(client, date)
+        counter = datastore.Entity(key=first, exclude_from_indexes=tuple(counts))
+        counter["date"] = date
+        counter.update(counts)
+        with client.transaction():
+            client.put(counter)
+            client.delete_multi(others)
+    return sorted(totals)
+
+
+if __name__ == "__main__":
+    for rebuilt in rebuild(datastore.Client(), sys.argv[1:]):
+        print(f"rebuilt {rebuilt}")
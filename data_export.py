@@ -0,0 +1,81 @@
+import csv
+import datetime
+import io
+import json
+from zoneinfo import ZoneInfo
+
+import config
+
+CHUNK_SIZE = 500
+
+NOTICE_COLUMNS = ["createdAt", "child", "grade", "classroom", "category",
+                  "when", "description"]
+ARCHIVE_COLUMNS = ["user_id", "id"] + NOTICE_COLUMNS
+USER_COLUMNS = ["user_id", "child_name", "grade", "classroom", "isEnglish",
+                "isTeacher", "createdAt"]
+KINDS = {
+    "notices": ("SentActionKind", NOTICE_COLUMNS),
+    "users": ("UserKind", USER_COLUMNS),
+}
+
+
+def build_query(client, kind, start=None, end=None, grade=None, classroom=None):
+    query = client.query(kind=kind)
+    if grade is not None:
+        query.add_filter("grade", "=", grade)
+    if classroom is not None:
+        query.add_filter("classroom", "=", classroom)
+    if start is not None:
+        query.add_filter("createdAt", ">=", start)
+    if end is not None:
+        query.add_filter("createdAt", "<", end)
+    if start is not None or end is not None:
+        query.order = ["createdAt"]
+    return query
+
+
+def iter_entities(query, chunk_size=CHUNK_SIZE):
+    """
+    Walks the query CHUNK_SIZE entities at a time with cursors, so only one
+    chunk is held in memory.
+    """
+
+    cursor = None
+    while True:
+        iterator = query.fetch(limit=chunk_size, start_cursor=cursor)
+        page = list(next(iterator.pages, []))
+        yield page
+        cursor = iterator.next_page_token
+        if not page or cursor is None:
+            return
+
+
+def row(entity, columns):
+    values = {}
+    for column in columns:
+        if column == "user_id" and hasattr(entity, "key"):
+            values[column] = entity.key.name
+        elif column == "createdAt" and entity.get(column) is not None:
+            values[column] = datetime.datetime.fromtimestamp(
+                entity[column] / 1e3, ZoneInfo(config.TIMEZONE)).isoformat()
+        else:
+            values[column] = entity.get(column)
+    return values
+
+
+def stream_csv(chunks, columns):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writeheader()
+    for chunk in chunks:
+        for entity in chunk:
+            writer.writerow(row(entity, columns))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def stream_jsonl(chunks, columns):
+    for chunk in chunks:
+        yield "".join(json.dumps(row(entity, columns), ensure_ascii=False) + "\n"
+                      for entity in chunk)
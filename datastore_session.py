@@ -0,0 +1,147 @@
+import time
+
+from google.cloud import datastore
+from google.cloud.datastore.batch import Batch
+from google.cloud.datastore.query import Query
+from google.cloud.datastore.transaction import Transaction
+
+from metrics import REGISTRY
+
+DATASTORE_SECONDS = REGISTRY.histogram(
+    "datastore_request_seconds", "Datastore call latency", ["operation"])
+DATASTORE_ERRORS = REGISTRY.counter(
+    "datastore_errors_total", "Datastore calls that raised", ["operation"])
+OPERATIONS = {
+    operation: (DATASTORE_SECONDS.labels(operation), DATASTORE_ERRORS.labels(operation))
+    for operation in ("get", "query", "commit")}
+
+
+class EventSession:
+    """
+    Datastore access for one LINE event: the entities the event needs are
+    read with one get_multi, and puts/deletes are collected and written
+    together by commit() in one batch.
+
+    With an EntityCache, cached kinds are served from it when possible and
+    written through to it on commit, deletes included.
+    """
+
+    def __init__(self, client, cache=None):
+        self.client = client
+        self.cache = cache
+        self._puts = {}
+        self._deletes = {}
+
+    def _cached(self, key):
+        if self.cache is None or not self.cache.caches(key):
+            return False, None
+        return self.cache.get(key)
+
+    def get_multi(self, keys):
+        """
+        Entities for keys, None where there is none. Datastore is only called
+        for the keys the cache cannot answer, and not at all if it answers
+        every one.
+        """
+
+        entities = {}
+        missing = []
+        for key in keys:
+            hit, entity = self._cached(key)
+            if hit:
+                entities[key.flat_path] = entity
+            else:
+                missing.append(key)
+        if missing:
+            for entity in self.client.get_multi(missing):
+                entities[entity.key.flat_path] = entity
+                if self.cache is not None and self.cache.caches(entity.key):
+                    self.cache.put(entity)
+            if self.cache is not None:
+                for key in missing:
+                    if key.flat_path not in entities and self.cache.caches(key):
+                        self.cache.put_missing(key)
+        return [entities.get(key.flat_path) for key in keys]
+
+    def put(self, entity):
+        if self.cache is not None and self.cache.caches(entity.key):
+            # a write timestamp in ms, so an entity built from scratch to
+            # replace an existing one still gets a newer version
+            entity["version"] = max(entity.get("version", 0) + 1, int(time.time() * 1e3))
+        self._deletes.pop(entity.key.flat_path, None)
+        self._puts[entity.key.flat_path] = entity
+
+    def delete(self, key):
+        self._puts.pop(key.flat_path, None)
+        self._deletes[key.flat_path] = key
+
+    def commit(self):
+        if not self._puts and not self._deletes:
+            return
+        batch = self.client.batch()
+        batch.begin()
+        for entity in self._puts.values():
+            batch.put(entity)
+        for key in self._deletes.values():
+            batch.delete(key)
+        batch.commit()
+        if self.cache is not None:
+            for entity in self._puts.values():
+                if self.cache.caches(entity.key):
+                    self.cache.put(entity, written=True)
+            for key in self._deletes.values():
+                if self.cache.caches(key):
+                    self.cache.put_missing(key, written=True)
+        self._puts.clear()
+        self._deletes.clear()
+
+
+class InstrumentedClient(datastore.Client):
+    """
+    datastore.Client timing its RPCs by operation: get (lookups, including
+    the single-entity get), query (each page fetched) and commit (batches
+    and transactions, which is also where put_multi and delete_multi send
+    their writes).
+    """
+
+    def get_multi(self, *args, **kwargs):
+        seconds, errors = OPERATIONS["get"]
+        with seconds.time(errors):
+            return super().get_multi(*args, **kwargs)
+
+    def query(self, **kwargs):
+        return InstrumentedQuery(self, **kwargs)
+
+    def batch(self):
+        return InstrumentedBatch(self)
+
+    def transaction(self, **kwargs):
+        return InstrumentedTransaction(self, **kwargs)
+
+
+class InstrumentedQuery(Query):
+    def fetch(self, *args, **kwargs):
+        iterator = super().fetch(*args, **kwargs)
+        next_page = iterator._next_page  # pylint: disable=protected-access
+        seconds, errors = OPERATIONS["query"]
+
+        def timed_next_page():
+            with seconds.time(errors):
+                return next_page()
+
+        iterator._next_page = timed_next_page  # pylint: disable=protected-access
+        return iterator
+
+
+class InstrumentedBatch(Batch):
+    def commit(self, *args, **kwargs):
+        seconds, errors = OPERATIONS["commit"]
+        with seconds.time(errors):
+            return super().commit(*args, **kwargs)
+
+
+class InstrumentedTransaction(Transaction):
+    def commit(self, *args, **kwargs):
+        seconds, errors = OPERATIONS["commit"]
+        with seconds.time(errors):
+            return super().commit(*args, **kwargs)
@@ -0,0 +1,86 @@
+import json
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import config
+from outbox import connect
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digest (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email_address TEXT NOT NULL,
+    notice TEXT NOT NULL,
+    due_at REAL NOT NULL
+)
+"""
+
+
+def next_boundary(now, minutes):
+    """
+    End of the current digest window. Windows are aligned to the clock in
+    config.TIMEZONE, so a 15 minute window flushes at :00, :15, :30 and :45
+    (and so before 8:00).
+    """
+
+    offset = datetime.fromtimestamp(now, ZoneInfo(config.TIMEZONE)).utcoffset().total_seconds()
+    window = minutes * 60
+    return ((now + offset) // window + 1) * window - offset
+
+
+class DigestQueue:
+    """
+    Holds notices per teacher email address until the end of their digest
+    window, then hands them to the outbox as one "digest" payload.
+    """
+
+    def __init__(self, path, outbox, poll_interval=30.0):
+        self.outbox = outbox
+        self.poll_interval = poll_interval
+        self._db = connect(path)
+        self._db.execute(SCHEMA)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._worker = None
+
+    def add(self, email_address, minutes, **notice):
+        due_at = next_boundary(time.time(), minutes)
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO digest (email_address, notice, due_at) "
+                "VALUES (?, ?, ?)",
+                (email_address, json.dumps(notice), due_at))
+
+    def start(self):
+        self._worker = threading.Thread(target=self._loop, daemon=True)
+        self._worker.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+    def flush(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, email_address, notice FROM digest "
+                "WHERE email_address IN "
+                "(SELECT email_address FROM digest WHERE due_at <= ?) "
+                "ORDER BY id", (now,)).fetchall()
+            digests = {}
+            for _, email_address, notice in rows:
+                digests.setdefault(email_address, []).append(json.loads(notice))
+            # enqueue before deleting: a crash in between sends a digest
+            # twice rather than losing it
+            for email_address, notices in digests.items():
+                self.outbox.enqueue(kind="digest", notices=notices,
+                                    email_address=email_address)
+            self._db.executemany("DELETE FROM digest WHERE id = ?",
+                                 [(row[0],) for row in rows])
+        return len(digests)
+
+    def _loop(self):
+        while not self._stopped.wait(self.poll_interval):
+            self.flush()
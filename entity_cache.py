@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import OrderedDict
+
+from google.cloud import datastore
+
+
+def copy_entity(entity):
+    copy = datastore.Entity(key=entity.key,
+                            exclude_from_indexes=tuple(entity.exclude_from_indexes))
+    copy.update(entity)
+    return copy
+
+
+class EntityCache:
+    """
+    In-process LRU cache with TTL for rarely changing entities (by kind),
+    filled by reads and kept up to date by writes that go through
+    EventSession. Keys known to have no entity are cached too, so a lookup
+    of e.g. a missing ActionKind needs no Datastore call either.
+
+    Cached entities carry a "version" property that EventSession sets to
+    the write time (and at least one more than before) on every write. A
+    read never replaces a cached entity with an older version, and entries
+    older than verify_after seconds are read again so that changes made by
+    other instances show up within that time.
+    """
+
+    def __init__(self, kinds, max_size=1024, ttl=300.0, verify_after=None):
+        self.kinds = frozenset(kinds)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.verify_after = verify_after
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def caches(self, key):
+        return key.kind in self.kinds
+
+    def _fresh(self, stored_at, now):
+        age = now - stored_at
+        return age <= self.ttl and (self.verify_after is None or age <= self.verify_after)
+
+    def get(self, key):
+        """
+        (True, entity) on a hit, with entity None if the key is cached as
+        having no entity, and (False, None) on a miss.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key.flat_path)
+            if entry is not None and self._fresh(entry[1], now):
+                self._entries.move_to_end(key.flat_path)
+                self.hits += 1
+                return True, None if entry[0] is None else copy_entity(entry[0])
+            self.misses += 1
+            return False, None
+
+    def put(self, entity, written=False):
+        """
+        written is True for entities the app just wrote, which always
+        replace the cached copy. Entities read from Datastore only do if
+        they are at least as new.
+        """
+
+        with self._lock:
+            entry = self._entries.get(entity.key.flat_path)
+            if entry is not None and not written:
+                if entry[0] is None:
+                    # deleted through this cache after the read started
+                    if self._fresh(entry[1], time.monotonic()):
+                        return
+                else:
+                    cached_version = entry[0].get("version", 0)
+                    if entity.get("version", 0) < cached_version:
+                        return
+                    if entity.get("version", 0) > cached_version:
+                        self.stale += 1
+            self._store(entity.key, copy_entity(entity))
+
+    def put_missing(self, key, written=False):
+        """
+        Caches that key has no entity: written for a delete the app just
+        committed, otherwise a read that found nothing. Such a read does not
+        replace an entry written since it started.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key.flat_path)
+            if (entry is not None and not written
+                    and self._fresh(entry[1], time.monotonic())):
+                return
+            self._store(key, None)
+
+    def _store(self, key, entity):
+        self._entries[key.flat_path] = (entity, time.monotonic())
+        self._entries.move_to_end(key.flat_path)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key.flat_path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "stale": self.stale,
+                "size": len(self._entries),
+            }
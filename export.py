@@ -0,0 +1,64 @@
+import numpy as np
+import torch
+from model import NeuralNet
+import numpy_model
+
+PTH_FILE = "data.pth"
+NPZ_FILE = "data.npz"
+TOLERANCE = 1e-5
+
+
+def export(pth_file=PTH_FILE, npz_file=NPZ_FILE):
+    data = torch.load(pth_file)
+    weights = {name: tensor.cpu().numpy()
+               for name, tensor in data["model_state"].items()}
+    np.savez(npz_file, all_words=np.array(data["all_words"]),
+             tags=np.array(data["tags"]), **weights)
+    check_parity(data, npz_file)
+
+
+def parity_inputs(input_size):
+    # every single word, then random bags of about 5% of the vocabulary
+    rng = np.random.default_rng(0)
+    return np.concatenate([
+        np.eye(input_size, dtype=np.float32),
+        (rng.random((256, input_size)) < 0.05).astype(np.float32),
+    ])
+
+
+def torch_probabilities(data, X):
+    model = NeuralNet(data["input_size"], data["hidden_size"],
+                      data["output_size"])
+    model.load_state_dict(data["model_state"])
+    model.eval()
+    with torch.no_grad():
+        return torch.softmax(model(torch.from_numpy(X)), dim=1).numpy()
+
+
+def check_parity(data, npz_file):
+    """
+    Raises ValueError if the NumPy model in npz_file does not predict what
+    the torch model in data does.
+    """
+
+    np_model, all_words, tags = numpy_model.load(npz_file)
+    if all_words != list(data["all_words"]) or tags != list(data["tags"]):
+        raise ValueError(f"{npz_file}: words or tags differ from the torch model")
+
+    X = parity_inputs(data["input_size"])
+    expected = torch_probabilities(data, X)
+    outputs = {
+        "forward": np_model.forward(X),
+        "forward_indices": np_model.forward_indices([row.nonzero()[0] for row in X]),
+    }
+    for name, output in outputs.items():
+        actual = numpy_model.softmax(output)
+        difference = np.abs(expected - actual).max()
+        if difference > TOLERANCE or (expected.argmax(axis=1) != actual.argmax(axis=1)).any():
+            raise ValueError(
+                f"{npz_file}: {name} differs from the torch model by up to {difference:g}")
+
+
+if __name__ == "__main__":
+    export()
+    print(f'{PTH_FILE} exported to {NPZ_FILE}')
@@ -0,0 +1,86 @@
+import re
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+
+from metrics import REGISTRY
+
+LINE_SECONDS = REGISTRY.histogram(
+    "line_api_request_seconds", "LINE Messaging API call latency", ["endpoint"])
+LINE_ERRORS = REGISTRY.counter(
+    "line_api_errors_total",
+    "LINE Messaging API calls that raised or answered with an error status", ["endpoint"])
+
+
+# path segments that name an endpoint ("v2", "profile", "richmenu", ...);
+# any other segment is an ID (user, group, message, rich menu) and is
+# replaced so the metrics get one series per endpoint, not per ID
+STATIC_SEGMENT = re.compile(r"[a-z][A-Za-z0-9]*")
+
+
+def endpoint_label(path):
+    return "/".join(segment if not segment or STATIC_SEGMENT.fullmatch(segment) else "{id}"
+                    for segment in path.split("/"))
+
+
+class PooledHttpClient(RequestsHttpClient):
+    """
+    LineBotApi HTTP client on one requests.Session, so reply and push calls
+    reuse keep-alive TLS connections instead of opening one per call.
+
+    Failed connects are retried for every method (nothing was sent yet);
+    read errors and 5xx responses only for idempotent methods, so a reply
+    token is never used twice. A 5xx left after the retries is returned, not
+    raised, so LineBotApi still raises LineBotApiError for it. Latency is
+    recorded per API endpoint.
+
+    LineBotApi instantiates its http_client class itself, so pass the extra
+    settings with functools.partial.
+    """
+
+    def __init__(self, timeout=(3.0, 10.0), pool_size=10, retries=2):
+        super().__init__(timeout=timeout)
+        retry = Retry(total=retries, connect=retries, read=retries,
+                      status=retries, backoff_factor=0.2,
+                      status_forcelist=(500, 502, 503, 504), raise_on_status=False,
+                      allowed_methods=frozenset(["GET", "PUT", "DELETE"]))
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.latency = {}
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        endpoint = endpoint_label(urlparse(url).path)
+        metrics = self.latency.get(endpoint)
+        if metrics is None:
+            metrics = self.latency.setdefault(
+                endpoint, (LINE_SECONDS.labels(endpoint), LINE_ERRORS.labels(endpoint)))
+        histogram, errors = metrics
+        with histogram.time(errors):
+            response = self.session.request(
+                method, url, timeout=timeout or self.timeout, **kwargs)
+        if response.status_code >= 400:
+            errors.inc()
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, timeout, headers=headers,
+                             params=params, stream=stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, timeout, headers=headers, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, timeout, headers=headers, data=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, timeout, headers=headers, data=data)
+
+    def stats(self):
+        return {path: histogram.snapshot()
+                for path, (histogram, _) in list(self.latency.items())}
@@ -0,0 +1,203 @@
+import bisect
+import threading
+import time
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """
+    Increments are plain additions without a lock, losing one to a race
+    between threads is an acceptable price for a cheap hot path.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """
+    Unlike counters, in-flight gauges take a lock: a lost inc or dec would
+    leave them off for good. A gauge given a function reports its result
+    instead, for values computed at scrape time.
+    """
+
+    __slots__ = ("value", "function", "_lock")
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets. observe() takes no lock: a sample
+    lost to a race between threads is an acceptable price for keeping the
+    hot path cheap.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+
+    def time(self, errors=None):
+        """
+        Context manager observing the time spent in the block, and counting
+        an exception raised out of it on the `errors` counter if given.
+        """
+
+        return _Timer(self, errors)
+
+    def quantile(self, q):
+        """
+        Estimate from the buckets, interpolating linearly inside the bucket
+        the quantile falls in. None without samples.
+        """
+
+        counts = list(self.counts)
+        rank = q * sum(counts)
+        if not rank:
+            return None
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def snapshot(self):
+        counts = list(self.counts)
+        return {
+            "buckets": dict(zip([*map(str, self.buckets), "+Inf"], counts)),
+            "count": sum(counts),
+            "sum": self.total,
+        }
+
+
+class _Timer:
+    __slots__ = ("histogram", "errors", "start")
+
+    def __init__(self, histogram, errors=None):
+        self.histogram = histogram
+        self.errors = errors
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+        if exc_type is not None and self.errors is not None:
+            self.errors.inc()
+
+
+class Family:
+    """
+    One metric name with its label names. labels() returns the child for a
+    set of label values, creating it on first use, so hot paths should look
+    their children up once and keep them.
+    """
+
+    def __init__(self, name, documentation, kind, labelnames, factory):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self._lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+
+class Registry:
+    def __init__(self):
+        self.families = {}
+
+    def _family(self, name, documentation, kind, labelnames, factory):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families.setdefault(
+                name, Family(name, documentation, kind, labelnames, factory))
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._family(name, documentation, "counter", labelnames, Counter)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._family(name, documentation, "gauge", labelnames, Gauge)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._family(name, documentation, "histogram", labelnames,
+                            lambda: Histogram(buckets))
+
+    def render(self):
+        """
+        Prometheus text exposition format.
+        """
+
+        lines = []
+        for family in list(self.families.values()):
+            lines.append(f"# HELP {family.name} {family.documentation}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for values, child in list(family.children.items()):
+                labels = list(zip(family.labelnames, values))
+                if family.kind == "histogram":
+                    counts = list(child.counts)
+                    cumulative = 0
+                    for bound, count in zip([*map(str, child.buckets), "+Inf"], counts):
+                        cumulative += count
+                        lines.append(f"{family.name}_bucket{_labels(labels + [('le', bound)])} {cumulative}")
+                    lines.append(f"{family.name}_sum{_labels(labels)} {child.total}")
+                    lines.append(f"{family.name}_count{_labels(labels)} {cumulative}")
+                else:
+                    value = child.get() if family.kind == "gauge" else child.value
+                    lines.append(f"{family.name}{_labels(labels)} {'NaN' if value is None else value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+REGISTRY = Registry()
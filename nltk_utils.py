@@ -1,27 +1,103 @@
+import re
+from functools import lru_cache
 import nltk
 import numpy as np
 from nltk.stem.porter import PorterStemmer
+import config
 stemmer = PorterStemmer()
 
+# Mirrors what nltk.word_tokenize does on short chat messages: contractions
+# ("do", "n't" / "What", "'s"), "..." and decimals stay whole, any other
+# punctuation becomes its own token.
+TOKEN_PATTERN = re.compile(
+    r"\w+(?=n't\b|'(?:s|re|ve|ll|d|m)\b)|n't\b|'(?:s|re|ve|ll|d|m)\b"
+    r"|\d+(?:[.,]\d+)+|\w+(?:'\w+)*|\.\.\.|[^\w\s]",
+    re.IGNORECASE)
 
-def tokenize(sentence):
+
+def nltk_tokenize(sentence):
     return nltk.word_tokenize(sentence)
 
 
+def regex_tokenize(sentence):
+    return TOKEN_PATTERN.findall(sentence)
+
+
+TOKENIZERS = {
+    "nltk": nltk_tokenize,
+    "regex": regex_tokenize,
+}
+
+
+def check_tokenizer(name):
+    """
+    Fails at import rather than on the first chat message when the configured
+    tokenizer cannot run: the runtime image has no NLTK punkt data.
+    """
+
+    if name not in TOKENIZERS:
+        raise ValueError(f"TOKENIZER must be one of {sorted(TOKENIZERS)}, not {name!r}")
+    if name == "nltk":
+        # tokenizing once finds whichever data this NLTK version loads:
+        # punkt before 3.8.2, punkt_tab since
+        try:
+            nltk_tokenize("Is the tokenizer installed?")
+        except LookupError as error:
+            raise RuntimeError(
+                "TOKENIZER=nltk needs the NLTK punkt/punkt_tab data, which the runtime "
+                "image does not include: use TOKENIZER=regex or install it "
+                "(python -m nltk.downloader punkt punkt_tab)") from error
+
+
+check_tokenizer(config.TOKENIZER)
+
+
+def tokenize(sentence):
+    return TOKENIZERS[config.TOKENIZER](sentence)
+
+
+@lru_cache(maxsize=4096)
 def stem(word):
     return stemmer.stem(word.lower())
 
 
-def bag_of_words(tokenized_sentence, all_words):
+def word_index(all_words):
+    """
+    words = ["hi","hello","I","you","bye","thank","cool"]
+    index = {"hi": 0, "hello": 1, "I": 2, ...}
+    """
+
+    return {word: index for index, word in enumerate(all_words)}
+
+
+def word_indices(tokenized_sentence, words_index):
     """
     sentence = ["hello","how","are","you"]
     words = ["hi","hello","I","you","bye","thank","cool"]
-    bag =   [0,      1,    0,   1,    0,     0,     0]
+    indices = (1, 3)
+    """
+
+    indices = set()
+    for word in tokenized_sentence:
+        index = words_index.get(stem(word))
+        if index is not None:
+            indices.add(index)
+    return tuple(sorted(indices))
+
+
+def bags_of_words(tokenized_sentences, words_index):
+    """
+    sentences = [["hello","how","are","you"], ["bye"]]
+    words = ["hi","hello","I","you","bye","thank","cool"]
+    bags =  [[0,      1,    0,   1,    0,     0,     0],
+             [0,      0,    0,   0,    1,     0,     0]]
+
+    One row per sentence, set from word_indices. words_index is the mapping
+    returned by word_index(words).
     """
 
-    sentence_words = [stem(word) for word in tokenized_sentence]
-    bag = np.zeros(len(all_words), dtype=np.float32)
-    for index, word in enumerate(all_words):
-        if word in sentence_words:
-            bag[index] = 1.0
-    return bag
+    bags = np.zeros((len(tokenized_sentences), len(words_index)),
+                    dtype=np.float32)
+    for row, tokenized_sentence in enumerate(tokenized_sentences):
+        bags[row, list(word_indices(tokenized_sentence, words_index))] = 1.0
+    return bags
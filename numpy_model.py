@@ -0,0 +1,53 @@
+from itertools import chain
+import numpy as np
+
+
+class NumpyNeuralNet:
+    """
+    NumPy port of model.NeuralNet for inference, so the chat bot does not
+    need torch at runtime. Weights come from the data.npz written by export.py.
+    """
+
+    def __init__(self, weights):
+        self.w1 = weights["l1.weight"].T.copy()
+        self.b1 = weights["l1.bias"]
+        self.w2 = weights["l2.weight"].T.copy()
+        self.b2 = weights["l2.bias"]
+        self.w3 = weights["l3.weight"].T.copy()
+        self.b3 = weights["l3.bias"]
+
+    def forward(self, x):
+        return self._head(x @ self.w1 + self.b1)
+
+    def forward_indices(self, index_lists):
+        """
+        Same as forward for one-hot bags given as lists of active columns.
+        The first layer sums the weight rows of those columns instead of
+        multiplying the whole (mostly zero) bag.
+        """
+
+        out = np.tile(self.b1, (len(index_lists), 1))
+        rows = np.repeat(np.arange(len(index_lists)),
+                         [len(indices) for indices in index_lists])
+        cols = np.fromiter(chain.from_iterable(index_lists), dtype=np.intp,
+                           count=len(rows))
+        np.add.at(out, rows, self.w1[cols])
+        return self._head(out)
+
+    def _head(self, out):
+        out = np.maximum(out, 0)
+        out = np.maximum(out @ self.w2 + self.b2, 0)
+        return out @ self.w3 + self.b3
+
+
+def softmax(x):
+    exp = np.exp(x - x.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+def load(file):
+    with np.load(file) as data:
+        weights = {name: data[name] for name in data.files}
+    all_words = weights.pop("all_words").tolist()
+    tags = weights.pop("tags").tolist()
+    return NumpyNeuralNet(weights), all_words, tags
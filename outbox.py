@@ -0,0 +1,212 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL
+)
+"""
+
+# SQLite's WAL mode needs shared memory between connections, which these
+# filesystems cannot provide
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "9p", "fuse")
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+DEAD = "dead"
+
+
+def filesystem_type(path):
+    """
+    Type of the filesystem path is on, from /proc/mounts (None elsewhere).
+    """
+
+    directory = os.path.dirname(os.path.realpath(path))
+    try:
+        with open("/proc/mounts", encoding="utf-8") as mounts:
+            entries = [line.split()[1:3] for line in mounts]
+    except OSError:
+        return None
+    best = None
+    for mount_point, fs_type in entries:
+        if (directory == mount_point or directory.startswith(mount_point.rstrip("/") + "/")) \
+                and (best is None or len(mount_point) > len(best[0])):
+            best = (mount_point, fs_type)
+    return best and best[1]
+
+
+def connect(path):
+    """
+    SQLite connection for a queue file: WAL on a local disk, and on a
+    network filesystem the rollback journal with an exclusive lock, held for
+    as long as this (single) connection is open.
+    """
+
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    fs_type = filesystem_type(path) or ""
+    if fs_type.split(".")[0] in NETWORK_FILESYSTEMS:
+        db.execute("PRAGMA locking_mode=EXCLUSIVE")
+        db.execute("PRAGMA journal_mode=DELETE")
+    else:
+        db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+class Outbox:
+    """
+    Durable queue of notices in SQLite, delivered by background workers.
+
+    A notice stays in the table until send(**payload) returns, so a crash
+    while sending leads to a retry (at-least-once). Failed sends are retried
+    with exponential backoff and marked dead after max_attempts. Sent notices
+    are pruned by the workers once they are older than `retention` seconds.
+    """
+
+    def __init__(self, path, send, max_attempts=8, backoff=5.0,
+                 max_backoff=3600.0, lease=300.0, retention=7 * 86400.0,
+                 prune_every=3600.0):
+        self.send = send
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.retention = retention
+        self.prune_every = prune_every
+        self._next_prune = 0.0
+        self._db = connect(path)
+        self._db.execute(SCHEMA)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = False
+        self._workers = []
+
+    def enqueue(self, **payload):
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO outbox (payload, next_attempt, created_at) "
+                "VALUES (?, ?, ?)", (json.dumps(payload), now, now))
+            self._wakeup.notify()
+        return cursor.lastrowid
+
+    def start(self, workers=2):
+        for _ in range(workers):
+            worker = threading.Thread(target=self._loop, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout=None):
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def counts(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return dict(rows)
+
+    def dead_letters(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, payload, attempts, last_error FROM outbox "
+                "WHERE status = ? ORDER BY id", (DEAD,)).fetchall()
+        return [(row_id, json.loads(payload), attempts, error)
+                for row_id, payload, attempts, error in rows]
+
+    def retry_dead(self):
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET status = ?, attempts = 0, next_attempt = ? "
+                "WHERE status = ?", (PENDING, time.time(), DEAD))
+            self._wakeup.notify_all()
+
+    def _claim(self):
+        # notices left in "sending" past their lease (e.g. the process died
+        # mid-send) are claimed again
+        now = time.time()
+        self._db.execute("BEGIN IMMEDIATE")
+        row = self._db.execute(
+            "SELECT id, payload, attempts FROM outbox "
+            "WHERE (status = ? AND next_attempt <= ?) "
+            "OR (status = ? AND next_attempt <= ?) "
+            "ORDER BY next_attempt LIMIT 1",
+            (PENDING, now, SENDING, now)).fetchone()
+        if row is not None:
+            self._db.execute(
+                "UPDATE outbox SET status = ?, next_attempt = ? WHERE id = ?",
+                (SENDING, now + self.lease, row[0]))
+        self._db.execute("COMMIT")
+        return row
+
+    def prune(self):
+        """
+        Deletes notices sent more than `retention` seconds ago, returns how
+        many were deleted.
+        """
+
+        with self._lock:
+            return self._prune()
+
+    def _prune(self):
+        # next_attempt of a sent notice is the time it was sent
+        now = time.time()
+        self._next_prune = now + self.prune_every
+        return self._db.execute(
+            "DELETE FROM outbox WHERE status = ? AND next_attempt < ?",
+            (SENT, now - self.retention)).rowcount
+
+    def _next_wait(self):
+        row = self._db.execute(
+            "SELECT MIN(next_attempt) FROM outbox WHERE status IN (?, ?)",
+            (PENDING, SENDING)).fetchone()
+        until_prune = max(self._next_prune - time.time(), 0)
+        if row[0] is None:
+            return until_prune
+        return min(max(row[0] - time.time(), 0), until_prune)
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                if time.time() >= self._next_prune:
+                    self._prune()
+                row = self._claim()
+                while row is None and not self._stopping:
+                    self._wakeup.wait(self._next_wait())
+                    if time.time() >= self._next_prune:
+                        self._prune()
+                    row = self._claim()
+                if row is None:
+                    return
+            row_id, payload, attempts = row
+            try:
+                self.send(**json.loads(payload))
+            except Exception as error:  # pylint: disable=broad-except
+                self._failed(row_id, attempts + 1, error)
+            else:
+                with self._lock:
+                    self._db.execute(
+                        "UPDATE outbox SET status = ?, attempts = ?, "
+                        "next_attempt = ? WHERE id = ?",
+                        (SENT, attempts + 1, time.time(), row_id))
+
+    def _failed(self, row_id, attempts, error):
+        status = DEAD if attempts >= self.max_attempts else PENDING
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        with self._lock:
+            self._db.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, "
+                "last_error = ? WHERE id = ?",
+                (status, attempts, time.time() + delay, repr(error), row_id))
@@ -53,9 +53,43 @@ def teacher_buttons(words):
         action=DatetimePickerAction(
             label=words["seeActionsByDate"], data="teacher_seeActionsByDate", mode="date")
     )]
-    for option in ["seeActionsAll", "seeUsers", "setEmail", "deleteUser", "teacherOff"]:
+    for option in ["seeActionsAll", "todaySummary", "seeUsers", "setEmail", "broadcast", "digest", "deleteUser", "teacherOff"]:
         quick_buttons.append(QuickReplyButton(
             action=PostbackAction(
                 label=words[option], data="teacher_" + option, display_text=words[option])
         ))
     return quick_buttons
+
+
+def next_page_button(words, data):
+    return QuickReplyButton(
+        action=PostbackAction(
+            label=words["nextPage"], data=data, display_text=words["nextPage"]))
+
+
+def broadcast_target_buttons(words, grade=0):
+    """
+    Whole school and grades 1-6, or once a grade is picked the whole grade
+    and its classrooms 1-5. The last number of the data is 0 for "all".
+    """
+
+    if grade:
+        quick_buttons = [QuickReplyButton(
+            action=PostbackAction(
+                label=words["broadcastGrade"], data=f"teacher_broadcastTo_{grade}_0",
+                display_text=words["broadcastGrade"]))]
+        for classroom in range(1, 6):
+            quick_buttons.append(QuickReplyButton(
+                action=PostbackAction(
+                    label=f"{grade}-{classroom}", data=f"teacher_broadcastTo_{grade}_{classroom}",
+                    display_text=f"{grade}-{classroom}")))
+        return quick_buttons
+    quick_buttons = [QuickReplyButton(
+        action=PostbackAction(
+            label=words["broadcastAll"], data="teacher_broadcastTo_0_0",
+            display_text=words["broadcastAll"]))]
+    for number in range(1, 7):
+        quick_buttons.append(QuickReplyButton(
+            action=PostbackAction(
+                label=number, data=f"teacher_broadcastTo_{number}", display_text=number)))
+    return quick_buttons
@@ -0,0 +1,91 @@
+from linebot.models import QuickReply, StickerSendMessage, TextSendMessage
+
+from quick_buttons import (
+    number_buttons, menu_buttons, action_irregular_buttons,
+    action_others_buttons, teacher_buttons, broadcast_target_buttons)
+
+IRREGULAR_CHOICES = {
+    "absence": ["chooseDate", "absence", "date"],
+    "tardiness": ["chooseDateTime", "tardiness", "datetime"],
+    "leave_early": ["chooseDateTime", "leave_early", "datetime"],
+}
+OTHERS_CHOICES = {
+    "contactQuestion": ["contact", "question", "consult"],
+    "others": ["technical", "others"],
+}
+
+
+class Frozen:
+    """
+    A LINE SDK model serialized once. LineBotApi only ever calls
+    as_json_dict() on messages and their fields, so a Frozen object can be
+    sent (or set as a quick_reply) wherever the model itself could.
+    """
+
+    __slots__ = ("json",)
+
+    def __init__(self, model):
+        self.json = model.as_json_dict()
+
+    def as_json_dict(self):
+        return self.json
+
+
+def sticker(package_id, sticker_id):
+    return Frozen(StickerSendMessage(package_id=package_id, sticker_id=sticker_id))
+
+
+def text(message, quick_reply=None):
+    message = TextSendMessage(text=message)
+    # set afterwards, the constructor drops anything that isn't a QuickReply
+    message.quick_reply = quick_reply
+    return Frozen(message)
+
+
+class Replies:
+    """
+    Quick replies and fixed replies of one language, built and serialized
+    once at startup instead of on every event.
+    """
+
+    def __init__(self, words):
+        self.menu = Frozen(QuickReply(items=menu_buttons(words)))
+        self.teacher = Frozen(QuickReply(items=teacher_buttons(words)))
+        self.grades = Frozen(QuickReply(items=number_buttons(6, "grade")))
+        self.classrooms = Frozen(QuickReply(items=number_buttons(5, "classroom")))
+        self.ask_broadcast_target = {
+            grade: text(words["broadcastTarget"], Frozen(
+                QuickReply(items=broadcast_target_buttons(words, grade))))
+            for grade in range(7)}
+        self.proceed = {}
+        for category, choices in IRREGULAR_CHOICES.items():
+            self.proceed[category] = text(words[f"proceed_{category}"], Frozen(
+                QuickReply(items=action_irregular_buttons(words, choices))))
+        for category, choices in OTHERS_CHOICES.items():
+            self.proceed[category] = text(words[f"proceed_{category}"], Frozen(
+                QuickReply(items=action_others_buttons(words, choices))))
+        self.sent = {
+            key[:-len("Sent")]: (sticker("11538", "51626501"),
+                                 text(words[key], self.menu))
+            for key in words if key.endswith("Sent")}
+
+        self.ask_grade = text(words["grade"], self.grades)
+        self.ask_classroom = text(words["classroom"], self.classrooms)
+        self.bug = (sticker("11538", "51626499"), text(words["bug"], self.menu))
+        self.bug_unregistered = (text(words["bug"]), sticker("11538", "51626499"))
+        self.register_completed = (sticker("11537", "52002745"),
+                                   text(words["registerCompleted"], self.menu))
+        self.teacher_on = (sticker("11538", "51626514"),
+                           text(words["teacherMode"] + ": ON", self.teacher))
+        self.teacher_off = (sticker("11538", "51626494"),
+                            text(words["teacherMode"] + ": OFF", self.menu))
+        self.set_email_done = (sticker("11537", "52002768"),
+                               text(words["setEmailDone"], self.teacher))
+        self.under_construction = (sticker("11538", "51626508"),
+                                   text(words["underConstruction"], self.menu))
+        self.cancel_done = text(words["cancelDone"], self.menu)
+        self.teacher_cancel_done = text(words["cancelDone"], self.teacher)
+        self.dont_know = sticker("11537", "52002744")
+
+
+STICKER_REPLY = sticker("11537", "52002753")
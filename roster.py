@@ -0,0 +1,122 @@
+import csv
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core.exceptions import Conflict
+from google.cloud import datastore
+
+KIND = "RosterKind"
+# Datastore commits take at most 500 entities
+CHUNK_SIZE = 500
+# attempts of a chunk's transaction that conflicts with a parent's claim
+IMPORT_ATTEMPTS = 3
+LANGUAGES = {"ja": False, "japanese": False, "日本語": False,
+             "en": True, "english": True}
+
+
+def normalize_name(child_name):
+    # spaces are dropped so "山田 太郎" and "山田太郎" match
+    return "".join(child_name.split())
+
+
+def roster_key(client, grade, classroom, child_name):
+    return client.key(KIND, f"{grade}_{classroom}_{normalize_name(child_name)}")
+
+
+def parse_roster(client, text, timestamp):
+    """
+    Roster CSV with a header row: child_name, grade, classroom, language
+    (ja/en). Raises ValueError naming the first bad line.
+    """
+
+    entities = {}
+    for line, row in enumerate(csv.DictReader(io.StringIO(text)), start=2):
+        try:
+            child_name = row["child_name"].strip()
+            grade = int(row["grade"])
+            classroom = int(row["classroom"])
+            is_english = LANGUAGES[row.get("language", "ja").strip().lower()]
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError(f"line {line}: {row}") from error
+        if not child_name:
+            raise ValueError(f"line {line}: empty child_name")
+        entity = datastore.Entity(key=roster_key(client, grade, classroom, child_name))
+        entity.update({
+            "child_name": child_name,
+            "name": normalize_name(child_name),
+            "grade": grade,
+            "classroom": classroom,
+            "isEnglish": is_english,
+            "claimedBy": None,
+            "createdAt": timestamp,
+        })
+        entities[entity.key.flat_path] = entity
+    return list(entities.values())
+
+
+def import_roster(client, entities, workers=8):
+    """
+    Writes the roster in CHUNK_SIZE chunks, several chunks in parallel, each
+    in a transaction that keeps the claimedBy of entries a parent already
+    claimed. Returns the number of entities written.
+    """
+
+    def put_chunk(chunk):
+        for attempt in range(IMPORT_ATTEMPTS):
+            try:
+                with client.transaction():
+                    claimed = {entity.key.flat_path: entity["claimedBy"]
+                               for entity in client.get_multi([entity.key for entity in chunk])}
+                    for entity in chunk:
+                        entity["claimedBy"] = claimed.get(entity.key.flat_path)
+                    client.put_multi(chunk)
+                return
+            except Conflict:
+                # a parent claimed an entry of the chunk meanwhile
+                if attempt == IMPORT_ATTEMPTS - 1:
+                    raise
+
+    chunks = [entities[start:start + CHUNK_SIZE]
+              for start in range(0, len(entities), CHUNK_SIZE)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(put_chunk, chunks))
+    return len(entities)
+
+
+def find_claimable(client, child_name, user_id):
+    """
+    The roster entry a parent typing child_name can claim, or None if there
+    is no unclaimed entry with that name or more than one (the same name in
+    two classrooms).
+    """
+
+    query = client.query(kind=KIND)
+    query.add_filter("name", "=", normalize_name(child_name))
+    entries = [entry for entry in query.fetch(limit=10)
+               if entry["claimedBy"] in (None, user_id)]
+    return entries[0] if len(entries) == 1 else None
+
+
+def claim(client, key, user_id):
+    """
+    Marks the roster entry at key as claimed by user_id and returns it, or
+    None if it doesn't exist or another parent claimed it first.
+    """
+
+    with client.transaction():
+        entry = client.get(key)
+        if entry is None or entry["claimedBy"] not in (None, user_id):
+            return None
+        entry["claimedBy"] = user_id
+        client.put(entry)
+    return entry
+
+
+if __name__ == "__main__":
+    datastore_client = datastore.Client()
+    with open(sys.argv[1], encoding="utf-8-sig") as roster_file:
+        roster = parse_roster(datastore_client, roster_file.read(),
+                              int(time.time() * 1e3))
+    print(f"imported {import_roster(datastore_client, roster)} children")
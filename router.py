@@ -0,0 +1,134 @@
+import logging
+import re
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+# placeholders usable in postback templates: {} for any text, {int} for digits
+CONVERTERS = {"": (r"(.+)", str), "int": (r"(\d+)", int)}
+PLACEHOLDER = re.compile(r"\{(\w*)\}")
+
+ROUTE_SECONDS = REGISTRY.histogram(
+    "webhook_route_seconds", "Time spent in each conversation step", ["router", "route"])
+ROUTE_ERRORS = REGISTRY.counter(
+    "webhook_route_errors_total", "Conversation steps that raised", ["router", "route"])
+
+
+class Router:
+    """
+    Handler table keyed on a route name. Every dispatch is timed into a
+    per-route latency histogram (webhook_route_seconds, labelled with the
+    router's name), which also gives the call counts.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.handlers = {}
+        self.latency = {}
+        self.errors = {}
+
+    def add(self, key, handler):
+        if key in self.handlers and self.handlers[key] is not handler:
+            raise ValueError(f"route {key!r} is already taken")
+        self.handlers[key] = handler
+        self.latency[key] = ROUTE_SECONDS.labels(self.name, self.route_name(key))
+        self.errors[key] = ROUTE_ERRORS.labels(self.name, self.route_name(key))
+
+    @staticmethod
+    def route_name(key):
+        return key
+
+    def route(self, key):
+        def decorator(handler):
+            self.add(key, handler)
+            return handler
+        return decorator
+
+    def dispatch(self, key, *args):
+        handler = self.handlers.get(key)
+        if handler is None:
+            log.info("no route for %r", key)
+            return None
+        with self.latency[key].time(self.errors[key]):
+            return handler(*args)
+
+    def stats(self):
+        return {self.route_name(key): histogram.snapshot()
+                for key, histogram in self.latency.items()}
+
+
+class PostbackRouter(Router):
+    """
+    Routes postback data such as "grade_2", "menu_leave_early" or
+    "teacher_broadcastTo_3_1" from templates like "grade_{int}",
+    "menu_{}" and "teacher_broadcastTo_{int}_{int}".
+
+    Data without placeholders is found with a dict lookup, the rest with one
+    compiled regex whose trailing marker group names the matching template.
+    Either way parse() gives (namespace, action, args), and templates with
+    the same namespace and action share a handler and a histogram.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self._exact = {}
+        self._templates = []
+        self._pattern = None
+
+    def route(self, template):
+        def decorator(handler):
+            self.add_template(template, handler)
+            return handler
+        return decorator
+
+    def add_template(self, template, handler):
+        prefix = PLACEHOLDER.split(template, 1)[0].rstrip("_:")
+        namespace, _, action = prefix.partition("_")
+        self.add((namespace, action), handler)
+        if not PLACEHOLDER.search(template):
+            self._exact[template] = (namespace, action, ())
+            return
+        parts = PLACEHOLDER.split(template)
+        pattern = "".join(
+            re.escape(part) if i % 2 == 0 else CONVERTERS[part][0]
+            for i, part in enumerate(parts))
+        converters = [CONVERTERS[name][1] for name in parts[1::2]]
+        self._templates.append((pattern, namespace, action, converters))
+        # routes are added at import time, before any dispatch
+        self._pattern, self._groups = self._compile()
+
+    def _compile(self):
+        alternatives = []
+        groups = {}
+        group = 0
+        for index, (pattern, namespace, action, converters) in enumerate(self._templates):
+            alternatives.append(f"{pattern}(?P<t{index}>)")
+            groups[f"t{index}"] = (
+                namespace, action, converters, range(group + 1, group + 1 + len(converters)))
+            group += len(converters) + 1
+        return re.compile("|".join(alternatives)), groups
+
+    def parse(self, data):
+        parsed = self._exact.get(data)
+        if parsed is not None or self._pattern is None:
+            return parsed
+        match = self._pattern.fullmatch(data)
+        if match is None:
+            return None
+        namespace, action, converters, groups = self._groups[match.lastgroup]
+        return namespace, action, tuple(
+            convert(match.group(group)) for convert, group in zip(converters, groups))
+
+    def dispatch(self, data, *args):
+        parsed = self.parse(data)
+        if parsed is None:
+            log.info("no route for postback %r", data)
+            return None
+        namespace, action, values = parsed
+        return super().dispatch((namespace, action), *args, *values)
+
+    @staticmethod
+    def route_name(key):
+        namespace, action = key
+        return f"{namespace}_{action}" if action else namespace
@@ -1,437 +1,154 @@
-import smtplib
+from html import escape
+import string
 from email.message import EmailMessage
 import config
+from smtp_pool import SMTPPool
+from metrics import REGISTRY
 
 
 EMAIL_ADDRESS = config.EMAIL_USER
 EMAIL_PASSWORD = config.EMAIL_PASS
 
+CATEGORY_LABELS = {
+    "absence": "欠席",
+    "tardiness": "遅刻",
+    "leave_early": "早退",
+    "contact": "連絡",
+    "question": "質問",
+    "consult": "相談",
+    "answer": "回答",
+    "fileSubmit": "提出",
+    "technical": "このアプリに関する質問",
+    "others": "その他の連絡",
+}
+
+
+class CompiledTemplate:
+    """
+    ${name} template split once into literal chunks and field slots, so
+    rendering is a join. Field values are HTML-escaped.
+    """
+
+    def __init__(self, text):
+        self._parts = []
+        self._slots = []
+        position = 0
+        for match in string.Template.pattern.finditer(text):
+            name = match.group("braced") or match.group("named")
+            self._parts.append(text[position:match.start()])
+            if name is None:
+                self._parts.append(match.group())
+            else:
+                self._slots.append((len(self._parts), name))
+                self._parts.append("")
+            position = match.end()
+        self._parts.append(text[position:])
+
+    def render(self, safe=(), **values):
+        """
+        Fields named in safe are inserted as they are (already rendered HTML).
+        """
+
+        parts = list(self._parts)
+        for index, name in self._slots:
+            value = str(values[name])
+            parts[index] = value if name in safe else escape(value)
+        return "".join(parts)
+
+
+with open('templates/notice.html', encoding='utf-8') as template:
+    NOTICE_TEMPLATE = CompiledTemplate(template.read())
+with open('templates/digest.html', encoding='utf-8') as template:
+    DIGEST_TEMPLATE = CompiledTemplate(template.read())
+with open('templates/digest_row.html', encoding='utf-8') as template:
+    DIGEST_ROW_TEMPLATE = CompiledTemplate(template.read())
+
+SMTP_SECONDS = REGISTRY.histogram(
+    "smtp_send_seconds", "Time to send a batch of emails over a pooled SMTP session").labels()
+SMTP_ERRORS = REGISTRY.counter(
+    "smtp_errors_total", "Email batches that failed to send").labels()
+
+smtp_pool = SMTPPool(config.SMTP_HOST, config.SMTP_PORT,
+                     EMAIL_ADDRESS, EMAIL_PASSWORD,
+                     size=config.SMTP_POOL_SIZE,
+                     idle_timeout=config.SMTP_IDLE_TIMEOUT)
+
 
 def send_notice(child_name, grade, classroom, category, when, description, email_address):
-    if category == "absence":
-        email_category = "欠席"
-    elif category == "tardiness":
-        email_category = "遅刻"
-    elif category == "leave_early":
-        email_category = "早退"
-    elif category == "contact":
-        email_category = "連絡"
-    elif category == "question":
-        email_category = "質問"
-    elif category == "consult":
-        email_category = "相談"
-    elif category == "answer":
-        email_category = "回答"
-    elif category == "fileSubmit":
-        email_category = "提出"
-    elif category == "technical":
-        email_category = "このアプリに関する質問"
-    elif category == "others":
-        email_category = "その他の連絡"
+    send_many([build_notice(child_name, grade, classroom, category,
+                            when, description, email_address)])
+
+
+def send_digest(notices, email_address):
+    send_many([build_digest(notices, email_address)])
+
+
+def send_many(messages):
+    with SMTP_SECONDS.time(SMTP_ERRORS):
+        smtp_pool.send_many(messages)
+
+
+def deliver(kind="notice", **payload):
+    """
+    Send function for the outbox, payloads carry a kind ("notice" or "digest").
+    """
+
+    if kind == "digest":
+        send_digest(**payload)
     else:
-        email_category = "No Category"
+        send_notice(**payload)
+
+
+def build_notice(child_name, grade, classroom, category, when, description, email_address):
+    subject, text, html = render_notice(
+        child_name, grade, classroom, category, when, description)
     msg = EmailMessage()
-    msg['Subject'] = f"{email_category} Notice"
+    msg['Subject'] = subject
     msg['From'] = "bayezid1989@live.jp"
     msg['To'] = email_address
-    msg.set_content(f"{email_category} Notice")
-    msg.add_alternative("""\
-        <!DOCTYPE html>
-        <html lang="en" xmlns="http://www.w3.org/1999/xhtml" xmlns:v="urn:schemas-microsoft-com:vml" xmlns:o="urn:schemas-microsoft-com:office:office">
-        <head>
-            <meta charset="utf-8"> <!-- utf-8 works for most cases -->
-            <meta name="viewport" content="width=device-width"> <!-- Forcing initial-scale shouldn't be necessary -->
-            <meta http-equiv="X-UA-Compatible" content="IE=edge"> <!-- Use the latest (edge) version of IE rendering engine -->
-            <meta name="x-apple-disable-message-reformatting">  <!-- Disable auto-scale in iOS 10 Mail entirely -->
-            <title></title> <!-- The title tag shows in email notifications, like Android 4.4. -->
-        
-            <link href="https://fonts.googleapis.com/css?family=Poppins:200,300,400,500,600,700" rel="stylesheet">
-        
-            <!-- CSS Reset : BEGIN -->
-            <style>
-        
-                /* What it does: Remove spaces around the email design added by some email clients. */
-                /* Beware: It can remove the padding / margin and add a background color to the compose a reply window. */
-                html,
-        body {
-            margin: 0 auto !important;
-            padding: 0 !important;
-            height: 100% !important;
-            width: 100% !important;
-            background: #f1f1f1;
-        }
-        
-        /* What it does: Stops email clients resizing small text. */
-        * {
-            -ms-text-size-adjust: 100%;
-            -webkit-text-size-adjust: 100%;
-        }
-        
-        /* What it does: Centers email on Android 4.4 */
-        div[style*="margin: 16px 0"] {
-            margin: 0 !important;
-        }
-        
-        /* What it does: Stops Outlook from adding extra spacing to tables. */
-        table,
-        td {
-            mso-table-lspace: 0pt !important;
-            mso-table-rspace: 0pt !important;
-        }
-        
-        /* What it does: Fixes webkit padding issue. */
-        table {
-            border-spacing: 0 !important;
-            border-collapse: collapse !important;
-            table-layout: fixed !important;
-            margin: 0 auto !important;
-        }
-        
-        /* What it does: Uses a better rendering method when resizing images in IE. */
-        img {
-            -ms-interpolation-mode:bicubic;
-        }
-        
-        /* What it does: Prevents Windows 10 Mail from underlining links despite inline CSS. Styles for underlined links should be inline. */
-        a {
-            text-decoration: none;
-        }
-        
-        /* What it does: A work-around for email clients meddling in triggered links. */
-        *[x-apple-data-detectors],  /* iOS */
-        .unstyle-auto-detected-links *,
-        .aBn {
-            border-bottom: 0 !important;
-            cursor: default !important;
-            color: inherit !important;
-            text-decoration: none !important;
-            font-size: inherit !important;
-            font-family: inherit !important;
-            font-weight: inherit !important;
-            line-height: inherit !important;
-        }
-        
-        /* What it does: Prevents Gmail from displaying a download button on large, non-linked images. */
-        .a6S {
-            display: none !important;
-            opacity: 0.01 !important;
-        }
-        
-        /* What it does: Prevents Gmail from changing the text color in conversation threads. */
-        .im {
-            color: inherit !important;
-        }
-        
-        /* If the above doesn't work, add a .g-img class to any image in question. */
-        img.g-img + div {
-            display: none !important;
-        }
-        
-        /* What it does: Removes right gutter in Gmail iOS app: https://github.com/TedGoas/Cerberus/issues/89  */
-        /* Create one of these media queries for each additional viewport size you'd like to fix */
-        
-        /* iPhone 4, 4S, 5, 5S, 5C, and 5SE */
-        @media only screen and (min-device-width: 320px) and (max-device-width: 374px) {
-            u ~ div .email-container {
-                min-width: 320px !important;
-            }
-        }
-        /* iPhone 6, 6S, 7, 8, and X */
-        @media only screen and (min-device-width: 375px) and (max-device-width: 413px) {
-            u ~ div .email-container {
-                min-width: 375px !important;
-            }
-        }
-        /* iPhone 6+, 7+, and 8+ */
-        @media only screen and (min-device-width: 414px) {
-            u ~ div .email-container {
-                min-width: 414px !important;
-            }
-        }
-        
-        
-            </style>
-        
-            <!-- CSS Reset : END -->
-        
-            <!-- Progressive Enhancements : BEGIN -->
-            <style>
-        
-              .primary{
-          background: #17bebb;
-        }
-        .bg_white{
-          background: #ffffff;
-        }
-        .bg_light{
-          background: #f7fafa;
-        }
-        .bg_black{
-          background: #000000;
-        }
-        .bg_dark{
-          background: rgba(0,0,0,.8);
-        }
-        .email-section{
-          padding:2.5em;
-        }
-        
-        /*BUTTON*/
-        .btn{
-          padding: 10px 15px;
-          display: inline-block;
-        }
-        .btn.btn-primary{
-          border-radius: 5px;
-          background:  #108fac;
-          color: #ffffff;
-          margin-top: 2rem !important;
-          padding: 10px 15px;
-          display: inline-block;
-        }
-        .btn.btn-white{
-          border-radius: 5px;
-          background: #ffffff;
-          color: #000000;
-        }
-        .btn.btn-white-outline{
-          border-radius: 5px;
-          background: transparent;
-          border: 1px solid #fff;
-          color: #fff;
-        }
-        .btn.btn-black-outline{
-          border-radius: 0px;
-          background: transparent;
-          border: 2px solid #000;
-          color: #000;
-          font-weight: 700;
-        }
-        .btn-custom{
-          color: rgba(0,0,0,.3);
-          text-decoration: underline;
-        }
-        
-        h1,h2,h3,h4,h5,h6{
-          font-family: 'Poppins', sans-serif;
-          color: #000000;
-          margin-top: 0;
-          font-weight: 400;
-        }
-        
-        body{
-          font-family: 'Poppins', sans-serif;
-          font-weight: 400;
-          font-size: 15px;
-          line-height: 1.8;
-          color: rgba(0,0,0,.4);
-        }
-        
-        a{
-          color: #17bebb;
-        }
-        
-        table{
-        }
-        /*LOGO*/
-        
-        .logo h1{
-          margin: 0;
-        }
-        .logo h1 a{
-          color: #108fac;
-          font-size: 24px;
-          font-weight: 700;
-          font-family: 'Poppins', sans-serif;
-        }
-        
-        /*HERO*/
-        .hero{
-          position: relative;
-          z-index: 0;
-        }
-        
-        .hero .text{
-          color: rgba(0,0,0,.3);
-        }
-        .hero .text h2{
-          color: #000;
-          font-size: 34px;
-          margin-bottom: 0;
-          font-weight: 200;
-          line-height: 1.4;
-        }
-        .hero .text h3{
-          font-size: 24px;
-          font-weight: 300;
-        }
-        .hero .text h2 span{
-          font-weight: 600;
-          color: #000;
-        }
-        
-        .text-author{
-          bordeR: 1px solid rgba(0,0,0,.05);
-          max-width: 50%;
-          margin: 0 auto;
-          padding: 2em;
-        }
-        .text-author img{
-          border-radius: 50%;
-          padding-bottom: 20px;
-        }
-        .text-author h3{
-          margin-bottom: 0;
-        }
-        ul.social{
-          padding: 0;
-        }
-        ul.social li{
-          display: inline-block;
-          margin-right: 10px;
-        }
-        
-        /*FOOTER*/
-        
-        .footer{
-          border-top: 1px solid rgba(0,0,0,.05);
-          color: rgba(0,0,0,.5);
-        }
-        .footer .heading{
-          color: #000;
-          font-size: 20px;
-        }
-        .footer ul{
-          margin: 0;
-          padding: 0;
-        }
-        .footer ul li{
-          list-style: none;
-          margin-bottom: 10px;
-        }
-        .footer ul li a{
-          color: rgba(0,0,0,1);
-        }
+    msg.set_content(text)
+    msg.add_alternative(html, subtype='html')
+    return msg
+
+
+def render_notice(child_name, grade, classroom, category, when, description):
+    email_category = CATEGORY_LABELS.get(category, "No Category")
+    html = NOTICE_TEMPLATE.render(
+        category=email_category, child_name=child_name, grade=grade,
+        classroom=classroom, when=when, description=description)
+    return f"{email_category} Notice", f"{email_category} Notice", html
+
+
+def build_digest(notices, email_address):
+    subject, text, html = render_digest(notices)
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = "bayezid1989@live.jp"
+    msg['To'] = email_address
+    msg.set_content(text)
+    msg.add_alternative(html, subtype='html')
+    return msg
+
 
-        .for-space {
-          margin-bottom: 5px !important;
-        }
-        
-        
-        @media screen and (max-width: 500px) {
-        
-        
-        }
-        
-        
-            </style>
-        
-        
-        </head>
-        
-        <body width="100%" style="margin: 0; padding: 0 !important; mso-line-height-rule: exactly; background-color: #f1f1f1;">
-          <center style="width: 100%; background-color: #f1f1f1;">
-            <div style="display: none; font-size: 1px;max-height: 0px; max-width: 0px; opacity: 0; overflow: hidden; mso-hide: all; font-family: sans-serif;">
-              &zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;&zwnj;&nbsp;
-            </div>
-            <div style="max-width: 600px; margin: 0 auto;" class="email-container">
-              <!-- BEGIN BODY -->
-              <table align="center" role="presentation" cellspacing="0" cellpadding="0" border="0" width="100%" style="margin: auto;">
-                <tr>
-                  <td valign="top" class="bg_white" style="padding: 1em 2.5em 0 2.5em;">
-                    <table role="presentation" border="0" cellpadding="0" cellspacing="0" width="100%">
-                      <tr>
-                        <td class="logo" style="text-align: center;">
-                        <h2 color: rgba(0, 255, 55, 0.459)>れんらくちょうbot</h2>
-                        </td>
-                      </tr>
-                    </table>
-                  </td>
-                </tr><!-- end tr -->
-                <tr>
-                  <td valign="middle" class="hero bg_white" style="padding: 2em 0 4em 0;">
-                    <table role="presentation" border="0" cellpadding="0" cellspacing="0" width="100%">
-                      <tr>
-                        <td style="padding: 0 2.5em; text-align: center; padding-bottom: 3em;">
-                          <div class="text">
-                            <h2>""" + str(email_category) + """がきた！</h2>
-                          </div>
-                        </td>
-                      </tr>
-                      <tr>
-                        <td style="text-align: center;">
-                          <div class="text-author">
-                            <img src=https://randomuser.me/api/portraits/lego/5.jpg alt="" style="width: 100px; max-width: 600px; height: auto; margin: auto; display: block;">
-                            <h3 class="name">""" + str(child_name) + """さん</h3>
-                            <p class="position for-space">""" + str(grade) + """年 """ + str(classroom) + """組</p>
-                            <p class="position for-space">""" + str(email_category) + """日時：""" + str(when) + """</p> 
-                            <p class="position for-space">""" + str(email_category) + """詳細：""" + str(description) + """</p>
-                           </div>
-                        </td>
-                      </tr>
-                    </table>
-                  </td>
-                </tr><!-- end tr -->
-              <!-- 1 Column Text + Button : END -->
-              </table>
-              <table align="center" role="presentation" cellspacing="0" cellpadding="0" border="0" width="100%" style="margin: auto;">
-                <tr>
-                  <td valign="middle" class="bg_light footer email-section">
-                    <table>
-                      <tr>
-                        <td valign="top" width="33.333%" style="padding-top: 20px;">
-                          <table role="presentation" cellspacing="0" cellpadding="0" border="0" width="100%">
-                            <tr>
-                              <td style="text-align: left; padding-right: 10px;">
-                                <h3 class="heading">About</h3>
-                                <p>I want to help teachers!
-                                </p>
-                              </td>
-                            </tr>
-                          </table>
-                        </td>
-                        <td valign="top" width="33.333%" style="padding-top: 20px;">
-                          <table role="presentation" cellspacing="0" cellpadding="0" border="0" width="100%">
-                            <tr>
-                              <td style="text-align: left; padding-left: 5px; padding-right: 5px;">
-                                <h3 class="heading">Contact Info</h3>
-                                <ul>
-                                  <li><span class="text">VORT Motoazabu B2, 3-1-35 Motoazabu, Minato-ku, Tokyo 106-0046</span></li>
-                                  <li><span class="text">+81-3-6821-1699</span></a></li>
-                                </ul>
-                              </td>
-                            </tr>
-                          </table>
-                        </td>
-                        <td valign="top" width="33.333%" style="padding-top: 20px;">
-                          <table role="presentation" cellspacing="0" cellpadding="0" border="0" width="100%">
-                            <tr>
-                              <td style="text-align: left; padding-left: 10px;">
-                                <h3 class="heading">Links</h3>
-                                <ul>
-                                  <li><a href="https://github.com/Bayezid1989/cc16-project.polyglottal" target="_blank" rel="noopener noreferrer">GitHub</a></li>
-                                </ul>
-                              </td>
-                            </tr>
-                          </table>
-                        </td>
-                      </tr>
-                    </table>
-                  </td>
-                </tr><!-- end: tr -->
-                <tr>
-                  <td class="bg_light" style="text-align: center;">
-                    <p>If you have no idea about this email, just ignore, thank you.</p>
-                  </td>
-                </tr>
-              </table>
-        
-            </div>
-          </center>
-        </body>
-        </html>        
-        """, subtype='html')
+def render_digest(notices):
+    """
+    notices are dicts with the send_notice fields, sorted here by grade,
+    classroom and category.
+    """
 
-    with smtplib.SMTP('in-v3.mailjet.com', 587) as smtp:
-        smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        smtp.send_message(msg)
+    notices = sorted(notices, key=lambda notice: (
+        notice["grade"], notice["classroom"], notice["category"]))
+    rows = []
+    lines = []
+    for notice in notices:
+        email_category = CATEGORY_LABELS.get(notice["category"], "No Category")
+        rows.append(DIGEST_ROW_TEMPLATE.render(
+            grade=notice["grade"], classroom=notice["classroom"],
+            category=email_category, child_name=notice["child_name"],
+            when=notice["when"], description=notice["description"]))
+        lines.append(
+            f"{notice['grade']}年 {notice['classroom']}組 {email_category}: "
+            f"{notice['child_name']}さん {notice['when']} {notice['description']}")
+    html = DIGEST_TEMPLATE.render(safe=("rows",), count=len(notices),
+                                  rows="".join(rows))
+    return f"{len(notices)}件 Digest Notice", "\n".join(lines), html
@@ -0,0 +1,103 @@
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+
+class SMTPPool:
+    """
+    Keeps logged-in SMTP sessions open between notices.
+
+    A session idle for longer than health_check_after is checked with NOOP
+    before reuse, one idle for longer than idle_timeout is closed. A session
+    that raises while in use is dropped instead of going back to the pool.
+    """
+
+    def __init__(self, host, port, user=None, password=None, size=2,
+                 idle_timeout=60.0, health_check_after=5.0, timeout=30.0):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.user:
+            smtp.login(self.user, self.password)
+        return smtp
+
+    @staticmethod
+    def _close(smtp):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def _is_healthy(self, smtp):
+        try:
+            return smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                smtp, last_used = self._idle.pop()
+            idle_for = time.monotonic() - last_used
+            if idle_for > self.idle_timeout:
+                self._close(smtp)
+            elif idle_for <= self.health_check_after or self._is_healthy(smtp):
+                return smtp
+            else:
+                smtp.close()
+        return self._connect()
+
+    def _checkin(self, smtp):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((smtp, time.monotonic()))
+                return
+        self._close(smtp)
+
+    @contextmanager
+    def session(self):
+        smtp = self._checkout()
+        try:
+            yield smtp
+        except BaseException:
+            smtp.close()
+            raise
+        self._checkin(smtp)
+
+    def send_many(self, messages):
+        """
+        Sends the messages over one session. If a reused session turns out
+        to be dead, the remaining messages are sent over a fresh one.
+        """
+
+        remaining = list(messages)
+        reconnected = False
+        while remaining:
+            try:
+                with self.session() as smtp:
+                    while remaining:
+                        smtp.send_message(remaining[0])
+                        remaining.pop(0)
+            except smtplib.SMTPServerDisconnected:
+                if reconnected:
+                    raise
+                reconnected = True
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for smtp, _ in idle:
+            self._close(smtp)
@@ -0,0 +1,96 @@
+import datetime
+import math
+from zoneinfo import ZoneInfo
+
+import config
+
+NOTICE_FIELDS = ["createdAt", "child", "grade", "classroom", "category",
+                 "when", "description"]
+# LINE allows 5 messages per reply and 5000 characters per text message
+MAX_MESSAGES = 5
+MAX_TEXT_LENGTH = 5000
+# and 300 characters of postback data
+MAX_POSTBACK_DATA = 300
+PAGE_PREFIX = "teacher_seeActionsPage"
+# a teacher's current notice list: its filters and the cursor of each page
+PAGE_KIND = "PageKind"
+
+
+def day_range(date):
+    """
+    createdAt range in ms for a "YYYY-MM-DD" date in config.TIMEZONE.
+    """
+
+    start = datetime.datetime.combine(
+        datetime.date.fromisoformat(date), datetime.time(),
+        tzinfo=ZoneInfo(config.TIMEZONE))
+    end = start + datetime.timedelta(days=1)
+    return int(start.timestamp() * 1e3), int(end.timestamp() * 1e3)
+
+
+def fetch_page(client, start=None, end=None, cursor=None,
+               page_size=config.TEACHER_PAGE_SIZE):
+    """
+    One page of SentActionKind notices, newest first, with only the
+    displayed fields. Returns (notices, next_cursor), next_cursor is None
+    on the last page.
+    """
+
+    query = client.query(kind="SentActionKind")
+    query.projection = NOTICE_FIELDS
+    if start is not None:
+        query.add_filter("createdAt", ">=", start)
+        query.add_filter("createdAt", "<", end)
+    query.order = ["-createdAt"]
+    iterator = query.fetch(limit=page_size, start_cursor=cursor)
+    notices = list(next(iterator.pages, []))
+    next_cursor = iterator.next_page_token
+    if not notices or next_cursor is None:
+        return notices, None
+    return notices, next_cursor.decode("ascii")
+
+
+def page_data(listing, page):
+    """
+    Postback data of a "next page" button. Cursors are far too long for
+    postback data, so they stay on the PageKind entity and the button only
+    names the list (the timestamp it was opened at) and the page.
+    """
+
+    data = f"{PAGE_PREFIX}:{listing}:{page}"
+    if len(data) > MAX_POSTBACK_DATA:
+        raise ValueError(f"postback data longer than {MAX_POSTBACK_DATA} characters")
+    return data
+
+
+def format_notice(notice, max_length):
+    time = datetime.datetime.fromtimestamp(
+        notice["createdAt"] / 1e3, ZoneInfo(config.TIMEZONE))
+    text = (f"名前(Name): {notice['child']}, {notice['grade']}年(Grade), "
+            f"{notice['classroom']}組(Classroom), 種類(Category): {notice['category']}, "
+            f"日時(When): {notice['when']}, 理由(Reason): {notice['description']}, "
+            f"登録日時(Created at): {time:%Y-%m-%d %H:%M:%S}")
+    if len(text) > max_length:
+        text = text[:max_length - 1] + "…"
+    return text
+
+
+def notice_texts(notices, separator="\n\n"):
+    """
+    Packs the notices into at most MAX_MESSAGES texts of MAX_TEXT_LENGTH.
+    Each notice is cut short if needed so that a full page always fits.
+    """
+
+    per_message = max(math.ceil(len(notices) / MAX_MESSAGES), 1)
+    max_length = (MAX_TEXT_LENGTH - len(separator) * (per_message - 1)) // per_message
+    texts = []
+    current = []
+    for notice in notices:
+        text = format_notice(notice, max_length)
+        if current and len(separator.join(current + [text])) > MAX_TEXT_LENGTH:
+            texts.append(separator.join(current))
+            current = []
+        current.append(text)
+    if current:
+        texts.append(separator.join(current))
+    return texts
@@ -0,0 +1,123 @@
+import pytest
+
+datastore = pytest.importorskip("google.cloud.datastore")
+
+from datastore_session import EventSession  # noqa: E402 pylint: disable=wrong-import-position
+from entity_cache import EntityCache  # noqa: E402 pylint: disable=wrong-import-position
+
+USER_KEY = datastore.Key("UserKind", "U1", project="test")
+ACTION_KEY = datastore.Key("ActionKind", "U1", parent=USER_KEY)
+CONFIG_KEY = datastore.Key("ConfigKind", "email", project="test")
+KEYS = [USER_KEY, ACTION_KEY, CONFIG_KEY]
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.puts = []
+        self.deletes = []
+
+    def begin(self):
+        pass
+
+    def put(self, entity):
+        self.puts.append(entity)
+
+    def delete(self, key):
+        self.deletes.append(key)
+
+    def commit(self):
+        for entity in self.puts:
+            self.client.entities[entity.key.flat_path] = entity
+        for key in self.deletes:
+            self.client.entities.pop(key.flat_path, None)
+
+
+class FakeClient:
+    """
+    The part of datastore.Client EventSession uses, counting lookups.
+    """
+
+    def __init__(self, *entities):
+        self.entities = {entity.key.flat_path: entity for entity in entities}
+        self.lookups = []
+
+    def get_multi(self, keys):
+        self.lookups.append(keys)
+        return [self.entities[key.flat_path] for key in keys
+                if key.flat_path in self.entities]
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+def entity(key, **properties):
+    result = datastore.Entity(key=key)
+    result.update(properties)
+    return result
+
+
+@pytest.fixture
+def client():
+    return FakeClient(entity(USER_KEY, child_name="Taro", isEnglish=False),
+                      entity(CONFIG_KEY, email="teacher@example.com"))
+
+
+@pytest.fixture
+def cache():
+    return EntityCache(("UserKind", "ActionKind", "ConfigKind"))
+
+
+def test_repeat_event_makes_no_lookup(client, cache):
+    user, action, configuration = EventSession(client, cache).get_multi(KEYS)
+    assert len(client.lookups) == 1
+    assert user["child_name"] == "Taro"
+    assert action is None
+    assert configuration["email"] == "teacher@example.com"
+
+    assert EventSession(client, cache).get_multi(KEYS) == [user, None, configuration]
+    assert len(client.lookups) == 1
+
+
+def test_writes_and_deletes_are_served_from_the_cache(client, cache):
+    EventSession(client, cache).get_multi(KEYS)
+    session = EventSession(client, cache)
+    session.put(entity(ACTION_KEY, category="absence", when="", description=""))
+    session.commit()
+
+    _, action, _ = EventSession(client, cache).get_multi(KEYS)
+    assert action["category"] == "absence"
+
+    session = EventSession(client, cache)
+    session.delete(ACTION_KEY)
+    session.commit()
+
+    _, action, _ = EventSession(client, cache).get_multi(KEYS)
+    assert action is None
+    assert len(client.lookups) == 1
+
+
+def test_invalidated_key_is_read_again(client, cache):
+    EventSession(client, cache).get_multi(KEYS)
+    cache.invalidate(USER_KEY)
+
+    EventSession(client, cache).get_multi(KEYS)
+    assert client.lookups[1] == [USER_KEY]
+
+
+def test_replacing_entity_gets_a_newer_version(client, cache):
+    old = entity(CONFIG_KEY, email="old@example.com", version=41)
+    client.entities[CONFIG_KEY.flat_path] = old
+    cache.put(old)
+
+    session = EventSession(client, cache)
+    session.put(entity(CONFIG_KEY, email=""))
+    session.commit()
+    assert client.entities[CONFIG_KEY.flat_path]["version"] > 41
+
+    # another instance holding version 41 accepts the re-read
+    other = EntityCache(("ConfigKind",))
+    other.put(old)
+    other.put(client.entities[CONFIG_KEY.flat_path])
+    assert other.get(CONFIG_KEY)[1]["email"] == ""
+    assert other.stale == 1
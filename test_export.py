@@ -0,0 +1,41 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+import export  # noqa: E402 pylint: disable=wrong-import-position
+import numpy_model  # noqa: E402 pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def exported(tmp_path):
+    npz_file = str(tmp_path / "data.npz")
+    export.export(export.PTH_FILE, npz_file)
+    return torch.load(export.PTH_FILE), npz_file
+
+
+def test_numpy_model_matches_torch(exported):
+    data, npz_file = exported
+    model, all_words, tags = numpy_model.load(npz_file)
+    assert all_words == list(data["all_words"])
+    assert tags == list(data["tags"])
+
+    X = export.parity_inputs(data["input_size"])
+    expected = export.torch_probabilities(data, X)
+    dense = numpy_model.softmax(model.forward(X))
+    sparse = numpy_model.softmax(
+        model.forward_indices([row.nonzero()[0] for row in X]))
+    np.testing.assert_allclose(dense, expected, atol=export.TOLERANCE)
+    np.testing.assert_allclose(sparse, expected, atol=export.TOLERANCE)
+    assert (dense.argmax(axis=1) == expected.argmax(axis=1)).all()
+
+
+def test_mismatch_is_an_error(exported):
+    data, npz_file = exported
+    with np.load(npz_file) as saved:
+        weights = {name: saved[name] for name in saved.files}
+    weights["l3.bias"][0] += 10.0  # always predicts the first tag
+    np.savez(npz_file, **weights)
+
+    with pytest.raises(ValueError, match="differs from the torch model"):
+        export.check_parity(data, npz_file)
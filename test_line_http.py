@@ -0,0 +1,105 @@
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+from urllib3.util import connection
+
+from line_http import PooledHttpClient, endpoint_label
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers LINE API calls with server.status and records the client port
+    of each request, which tells the connections apart.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append((self.path, self.client_address[1]))
+        body = b"{}" if self.server.status < 400 else b'{"message": "stub error"}'
+        self.send_response(self.server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.status = 200
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def line_bot_api(stub):
+    return LineBotApi(
+        "token", endpoint=f"http://127.0.0.1:{stub.server_address[1]}",
+        timeout=(1.0, 2.0), http_client=partial(PooledHttpClient, retries=2))
+
+
+def reply(line_bot_api):
+    line_bot_api.reply_message("reply-token", TextSendMessage(text="hi"))
+
+
+def test_connection_is_reused(stub, line_bot_api):
+    for _ in range(3):
+        reply(line_bot_api)
+    assert len(stub.requests) == 3
+    assert len({port for _, port in stub.requests}) == 1
+
+
+def test_connect_failure_is_retried(stub, line_bot_api, monkeypatch):
+    create_connection = connection.create_connection
+    failures = []
+
+    def refuse_once(*args, **kwargs):
+        if not failures:
+            failures.append(args)
+            raise ConnectionRefusedError("refused by the test")
+        return create_connection(*args, **kwargs)
+
+    monkeypatch.setattr(connection, "create_connection", refuse_once)
+    reply(line_bot_api)
+    assert len(failures) == 1
+    assert stub.requests == [("/v2/bot/message/reply", stub.requests[0][1])]
+
+
+def test_server_error_is_not_retried(stub, line_bot_api):
+    stub.status = 500
+    with pytest.raises(LineBotApiError):
+        reply(line_bot_api)
+    assert len(stub.requests) == 1
+
+
+def test_get_server_error_is_retried_then_raised_by_the_sdk(stub, line_bot_api):
+    stub.status = 500
+    with pytest.raises(LineBotApiError):
+        line_bot_api.get_profile("Uabc")
+    assert [path for path, _ in stub.requests] == ["/v2/bot/profile/Uabc"] * 3
+    assert list(line_bot_api.http_client.stats()) == ["/v2/bot/profile/{id}"]
+
+
+def test_endpoint_label_hides_ids():
+    assert endpoint_label("/v2/bot/message/reply") == "/v2/bot/message/reply"
+    assert endpoint_label("/v2/bot/profile/U4af4980629") == "/v2/bot/profile/{id}"
+    assert endpoint_label("/v2/bot/message/12345/content") == "/v2/bot/message/{id}/content"
+    assert (endpoint_label("/v2/bot/user/Uabc/richmenu/richmenu-88c05ef6")
+            == "/v2/bot/user/{id}/richmenu/{id}")
@@ -0,0 +1,110 @@
+import socket
+import time
+
+import pytest
+from aiosmtpd.controller import Controller
+
+import send_email
+import outbox as outbox_module
+from outbox import Outbox, PENDING, SENT
+from smtp_pool import SMTPPool
+
+NOTICE = {
+    "child_name": "Taro", "grade": 2, "classroom": 1, "category": "absence",
+    "when": "2026-10-19", "description": "fever", "email_address": "teacher@example.com",
+}
+
+
+class Sink:
+    """
+    aiosmtpd handler keeping the messages it receives. The first `reject`
+    messages are answered with a temporary failure.
+    """
+
+    def __init__(self, reject=0):
+        self.reject = reject
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.reject:
+            self.reject -= 1
+            return "451 Try again later"
+        self.messages.append(envelope)
+        return "250 OK"
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+@pytest.fixture
+def sink():
+    handler = Sink()
+    controller = Controller(handler, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    yield handler, controller
+    controller.stop()
+
+
+@pytest.fixture
+def outbox(sink, tmp_path, monkeypatch):
+    _, controller = sink
+    pool = SMTPPool(controller.hostname, controller.port)
+    monkeypatch.setattr(send_email, "smtp_pool", pool)
+    outbox = Outbox(str(tmp_path / "outbox.sqlite3"), send_email.deliver,
+                    backoff=0.05, max_attempts=3)
+    yield outbox
+    outbox.stop(5)
+    pool.close()
+
+
+def wait_for(outbox, counts, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while outbox.counts() != counts:
+        assert time.monotonic() < deadline, outbox.counts()
+        time.sleep(0.02)
+
+
+def test_notice_is_delivered(sink, outbox):
+    handler, _ = sink
+    outbox.enqueue(**NOTICE)
+    outbox.start(1)
+    wait_for(outbox, {SENT: 1})
+    assert len(handler.messages) == 1
+    assert handler.messages[0].rcpt_tos == ["teacher@example.com"]
+    assert b"Taro" in handler.messages[0].content
+
+
+def test_temporary_failure_is_retried(sink, outbox):
+    handler, _ = sink
+    handler.reject = 1
+    outbox.enqueue(**NOTICE)
+    outbox.start(1)
+    wait_for(outbox, {SENT: 1})
+    assert len(handler.messages) == 1
+    assert outbox.dead_letters() == []
+
+
+def test_prune_deletes_only_old_sent_notices(sink, outbox):
+    outbox.start(1)
+    for _ in range(2):
+        outbox.enqueue(**NOTICE)
+    wait_for(outbox, {SENT: 2})
+    outbox.stop(5)
+    outbox.enqueue(**NOTICE)
+    old = time.time() - outbox.retention - 60
+    outbox._db.execute(
+        "UPDATE outbox SET next_attempt = ? WHERE id = 1", (old,))
+
+    assert outbox.prune() == 1
+    assert outbox.counts() == {SENT: 1, PENDING: 1}
+
+
+def test_network_filesystem_uses_rollback_journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(outbox_module, "filesystem_type", lambda path: "nfs4")
+    db = outbox_module.connect(str(tmp_path / "outbox.sqlite3"))
+    assert db.execute("PRAGMA journal_mode").fetchone() == ("delete",)
+    assert db.execute("PRAGMA locking_mode").fetchone() == ("exclusive",)
+    db.close()
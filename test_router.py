@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+from conversation import message_state
+from router import PostbackRouter
+
+
+def handler(*args):
+    return args
+
+
+@pytest.fixture(scope="module")
+def router():
+    router = PostbackRouter("test")
+    for template in ["language_{}", "grade_{int}", "classroom_{int}",
+                     "roster_{int}_{int}_{}", "roster_no", "menu_{}",
+                     "action_submit_yes", "teacher_broadcastTo_{int}",
+                     "teacher_broadcastTo_{int}_{int}"]:
+        router.add_template(template, handler)
+    return router
+
+
+@pytest.mark.parametrize("data, parsed", [
+    ("grade_12", ("grade", "", (12,))),
+    ("classroom_3", ("classroom", "", (3,))),
+    ("language_english", ("language", "", ("english",))),
+    ("menu_leave_early", ("menu", "", ("leave_early",))),
+    ("action_submit_yes", ("action", "submit_yes", ())),
+    ("teacher_broadcastTo_3", ("teacher", "broadcastTo", (3,))),
+    ("teacher_broadcastTo_3_1", ("teacher", "broadcastTo", (3, 1))),
+    ("roster_2_1_山田_太郎", ("roster", "", (2, 1, "山田_太郎"))),
+    ("roster_no", ("roster", "no", ())),
+])
+def test_parse(router, data, parsed):
+    assert router.parse(data) == parsed
+
+
+@pytest.mark.parametrize("data", [
+    "grade_", "grade_two", "teacher_broadcastTo_", "unknown", "menu", ""])
+def test_unknown_data_is_not_parsed(router, data):
+    assert router.parse(data) is None
+
+
+def test_dispatch_passes_converted_values(router):
+    assert router.dispatch("teacher_broadcastTo_3_1", "turn") == ("turn", 3, 1)
+    assert router.dispatch("unknown", "turn") is None
+
+
+USER = {"child_name": "Taro", "grade": 2, "classroom": 1, "isTeacher": False}
+ACTION = {"category": "absence", "when": "2026-10-19", "description": ""}
+
+
+def turn(user=USER, action=None, text="hello", email="teacher@example.com"):
+    return SimpleNamespace(
+        user=user, action=action, configuration={"email": email},
+        event=SimpleNamespace(message=SimpleNamespace(text=text)))
+
+
+@pytest.mark.parametrize("state_turn, state", [
+    (turn(user=None), "new"),
+    (turn(user={**USER, "child_name": "", "classroom": -1, "claiming": True}), "claimName"),
+    (turn(user={**USER, "child_name": "", "classroom": -1}), "registrationBroken"),
+    (turn(user={**USER, "child_name": ""}), "childName"),
+    (turn(action={**ACTION, "when": ""}), "actionBroken"),
+    (turn(action={**ACTION, "category": "broadcast"}), "broadcastText"),
+    (turn(action=ACTION), "description"),
+    (turn(action={**ACTION, "description": "fever"}), "confirming"),
+    (turn(text="Teacher on"), "teacherOn"),
+    (turn(user={**USER, "isTeacher": True}, email=""), "email"),
+    (turn(user={**USER, "isTeacher": True}), "teacherOff"),
+    (turn(), "chat"),
+])
+def test_message_state(state_turn, state):
+    assert message_state(state_turn) == state
@@ -1,10 +1,13 @@
 import json
-from nltk_utils import tokenize, stem, bag_of_words
+from nltk_utils import (
+    tokenize, nltk_tokenize, regex_tokenize, stem, bags_of_words, word_index,
+    check_tokenizer)
 import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
 from model import NeuralNet
+from export import export
 
 with open('intents.json', 'r') as file:
     intents = json.load(file)
@@ -25,16 +28,24 @@ all_words = [stem(word) for word in all_words if word not in ignore_words]
 all_words = sorted(set(all_words))
 tags = sorted(set(tags))
 
-x_train = []
-y_train = []
-for (pattern_sentence, tag) in xy:
-    bag = bag_of_words(pattern_sentence, all_words)
-    x_train.append(bag)
-    label = tags.index(tag)
-    y_train.append(label)
 
-x_train = np.array(x_train)
-y_train = np.array(y_train)
+def vocabulary(tokenizer):
+    words = [stem(word)
+             for intent in intents["intents"]
+             for pattern in intent["patterns"]
+             for word in tokenizer(pattern) if word not in ignore_words]
+    return sorted(set(words))
+
+
+check_tokenizer("nltk")
+if vocabulary(nltk_tokenize) != vocabulary(regex_tokenize):
+    raise ValueError(
+        "nltk and regex tokenizers give different vocabularies for intents.json")
+
+words_index = word_index(all_words)
+x_train = bags_of_words([pattern_sentence for (pattern_sentence, _) in xy],
+                        words_index)
+y_train = np.array([tags.index(tag) for (_, tag) in xy])
 
 
 class ChatDataset(Dataset):
@@ -96,4 +107,6 @@ data = {
 FILE = "data.pth"
 torch.save(data, FILE)
 
+export(FILE)
+
 print(f'training complete. file saved to {FILE}')
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot import WebhookHandler
+from linebot.models import MessageEvent
+
+log = logging.getLogger(__name__)
+
+
+class KeyedExecutor:
+    """
+    Thread pool where tasks sharing a key run one after another in the order
+    they were submitted, while different keys run in parallel.
+
+    At most max_pending tasks wait at a time. When full, submit blocks until
+    a task finishes, so a flood slows the webhook instead of queueing
+    without bound.
+    """
+
+    def __init__(self, workers=4, max_pending=256):
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._closed = False
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.blocked = 0
+
+    def submit(self, key, func, *args):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("executor is shut down")
+            self.submitted += 1
+            if self.pending >= self.max_pending:
+                self.blocked += 1
+                while self.pending >= self.max_pending:
+                    self._changed.wait()
+            self.pending += 1
+            queue = self._queues.get(key)
+            if queue is None:
+                self._queues[key] = deque([(func, args)])
+                self._pool.submit(self._drain, key)
+            else:
+                queue.append((func, args))
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("webhook event failed")
+            with self._lock:
+                self.failed += 1
+        with self._lock:
+            self.completed += 1
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                func, args = queue.popleft()
+            self._run(func, args)
+            with self._lock:
+                self.pending -= 1
+                self._changed.notify_all()
+                if not queue:
+                    del self._queues[key]
+                    return
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self.pending,
+                "max_pending": self.max_pending,
+                "active_keys": len(self._queues),
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "blocked": self.blocked,
+            }
+
+    def shutdown(self, timeout=None):
+        """
+        Stops taking new tasks and waits up to timeout seconds for the
+        queued ones to finish.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            self._closed = True
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    log.warning("shutting down with %d webhook events pending",
+                                self.pending)
+                    break
+                self._changed.wait(remaining)
+        self._pool.shutdown(wait=False)
+
+
+def event_key(event):
+    source = event.source
+    return (getattr(source, "user_id", None) or getattr(source, "group_id", None)
+            or getattr(source, "room_id", None))
+
+
+def dispatch(handler, event):
+    """
+    Runs the function registered on handler for one parsed event, the way
+    WebhookHandler.handle does for each event of a body.
+    """
+
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(  # pylint: disable=protected-access
+            event.__class__.__name__ + '_' + event.message.__class__.__name__)
+    if func is None:
+        func = handler._handlers.get(  # pylint: disable=protected-access
+            event.__class__.__name__)
+    if func is None:
+        func = handler._default  # pylint: disable=protected-access
+    if func is None:
+        log.info("No handler of %s and no default handler",
+                 event.__class__.__name__)
+    else:
+        func(event)
+
+
+class QueuedWebhookHandler(WebhookHandler):
+    """
+    WebhookHandler that verifies and parses the body in the request, then
+    runs the registered handlers on a KeyedExecutor keyed by LINE user, so
+    the webhook can answer 200 straight away.
+    """
+
+    def __init__(self, channel_secret, executor):
+        super().__init__(channel_secret)
+        self.executor = executor
+
+    def handle(self, body, signature):
+        payload = self.parser.parse(body, signature, as_payload=True)
+        for event in payload.events:
+            self.executor.submit(event_key(event), dispatch, self, event)